@@ -1,31 +1,474 @@
-from backend.dependencies import db
-from google.cloud import firestore
+from backend.dependencies import db, get_bucket
+from backend.metrics import count_ops, inc, record_timing, timed
 from collections import defaultdict
-from firebase_admin import storage
 import uuid
+import os
+import io
+import gzip
+import json
+import itertools
+import heapq
+import bisect
+import asyncio
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, UnidentifiedImageError
+from enum import Enum
 from fastapi import UploadFile
 from datetime import datetime, timedelta, timezone
+# google.cloud.firestore and google.api_core are imported by the functions that use them,
+# they take a large part of the import of the app and the Firestore client is only built on first use either
 
 
 ITEM_TYPES = "item_types"
 FRIDGE_ITEMS = "fridge_items"
 CART = "cart"
 LOG = "change_log"
+ROLLUPS = "change_log_daily"
+META = "meta"
 
-def get_item_statistics(filter: str, start: str = None, end: str = None):
+# the most values Firestore accepts in one "in" filter
+IN_LIMIT = 30
+
+# the most writes Firestore accepts in one batch
+BATCH_LIMIT = 500
+
+# change log retention, older entries are moved into gzip NDJSON files, one per day, under ARCHIVE_DIR
+# every process reading the statistics needs the same directory, e.g. a mounted volume or bucket
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", 365))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_META_TTL = float(os.environ.get("ARCHIVE_META_TTL", 300))
+
+# number of rows on one page of the fridge, cart and change log tables
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+
+# photo pipeline settings, sizes are the longest side in pixels
+PHOTO_WORKERS = int(os.environ.get("PHOTO_WORKERS", 2))
+PHOTO_MAX_SIZE = int(os.environ.get("PHOTO_MAX_SIZE", 1600))
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", 160))
+PHOTO_CHUNK = 1024 * 1024
+# resumable uploads need a multiple of 256 KB
+UPLOAD_CHUNK = 4 * 1024 * 1024
+
+_photo_executor = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix="photo")
+logger = logging.getLogger(__name__)
+
+# length of the name pieces in the item type search index
+NGRAM = 3
+
+# how long the item type catalog is trusted without a snapshot listener, in seconds
+CATALOG_MAX_AGE = float(os.environ.get("CATALOG_MAX_AGE", 300))
+
+# default and largest look-ahead of the expiring items view, in days
+EXPIRING_DAYS = int(os.environ.get("EXPIRING_DAYS", 7))
+EXPIRING_MAX_DAYS = 366
+
+# how long a version of a collection without a snapshot listener is trusted, in seconds,
+# writes of other processes to it only become visible through the time
+VERSION_TTL = float(os.environ.get("VERSION_TTL", 30))
+
+# changes a live page may fall behind before it is told to reload
+MIRROR_QUEUE_SIZE = int(os.environ.get("MIRROR_QUEUE_SIZE", 1000))
+
+# identical reads running at the same time share one query, with a window in seconds
+# the result of a finished read is also handed to identical calls arriving within it, 0 turns that off
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0))
+
+
+# collection versions
+# a counter per collection, bumped by every write of this process and by the snapshot listeners for the writes of others
+# the counters start again with every process, the boot id tells the processes apart
+BOOT_ID = uuid.uuid4().hex[:8]
+_versions = defaultdict(int)
+_versions_lock = threading.Lock()
+
+def bump_version(*collections: str):
+    with _versions_lock:
+        for collection in collections:
+            _versions[collection] += 1
+
+def version_tag(*collections: str):
+    # changes whenever one of the collections may have changed
+    watched = {m.collection for m in mirrors.values() if m.ready()}
+    if catalog.listening():
+        watched.add(catalog.collection)
+    with _versions_lock:
+        parts = [f"{c}={_versions[c]}" for c in collections]
+    if not watched.issuperset(collections):
+        parts.append(str(int(time.time() // VERSION_TTL)))
+    return BOOT_ID + ":" + ",".join(parts)
+
+
+# request coalescing
+# the first call with a key runs the read, identical calls arriving while it runs wait for it and get the same result,
+# the key holds the versions of the collections read, so a call made after a write never gets a result from before it
+# the shared results are only read by the callers, never changed
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+_coalesce_counts = {"leaders": 0, "joined": 0, "cached": 0}
+
+def coalesce(key: tuple, collections: tuple, fn: any, *args):
+    key = (version_tag(*collections),) + key
+    now = time.monotonic()
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None and flight.finished_at is not None and now - flight.finished_at >= COALESCE_WINDOW:
+            flight = None
+        if flight is None:
+            # finished reads past the window are dropped whenever a new one starts
+            for k in [k for k, f in _flights.items() if f.finished_at is not None and now - f.finished_at >= COALESCE_WINDOW]:
+                del _flights[k]
+            flight = _flights[key] = Flight()
+            leader = True
+            _coalesce_counts["leaders"] += 1
+        else:
+            leader = False
+            kind = "cached" if flight.finished_at is not None else "joined"
+            _coalesce_counts[kind] += 1
+    if not leader:
+        inc("fridge_coalesced_reads_total", read=key[1])
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        flight.result = fn(*args)
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            if flight.error is not None or COALESCE_WINDOW <= 0:
+                _flights.pop(key, None)
+            else:
+                flight.finished_at = time.monotonic()
+        flight.done.set()
+    return flight.result
+
+def coalesce_stats():
+    with _flights_lock:
+        return dict(_coalesce_counts, in_flight=sum(1 for f in _flights.values() if f.finished_at is None), window=COALESCE_WINDOW)
+
+
+class ItemTypeCatalog:
+    # in-memory copy of the item types collection, indexed by id and by lowercase name
+    # it is kept current by a snapshot listener, or reloaded after a write or when it gets too old
+    def __init__(self, collection: str):
+        self.collection = collection
+        self.hits = 0
+        self.misses = 0
+        self._by_id = {}
+        self._by_name = {}
+        self._ngrams = {}
+        self._loaded_at = None
+        self._watch = None
+        self._lock = threading.RLock()
+
+    def start_listener(self):
+        with self._lock:
+            if self._watch is None:
+                self._watch = db.collection(self.collection).on_snapshot(self._on_snapshot)
+
+    def stop_listener(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # every snapshot holds the whole collection, so the index is simply rebuilt
+        self._replace({doc.id: doc.to_dict() | {"id": doc.id} for doc in docs})
+        bump_version(self.collection)
+
+    def _replace(self, types: dict):
+        by_name = {t.get("name", "").lower(): t for t in types.values()}
+        # every three letter piece of a name points to the types containing it, for substring search
+        ngrams = defaultdict(set)
+        for t in types.values():
+            for gram in name_ngrams(t.get("name", "").lower()):
+                ngrams[gram].add(t["id"])
+        with self._lock:
+            self._by_id = types
+            self._by_name = by_name
+            self._ngrams = dict(ngrams)
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded_at is not None and (self._watch is not None or self.age() < CATALOG_MAX_AGE):
+                self.hits += 1
+                return
+            self.misses += 1
+            docs = stream_docs(db.collection(self.collection))
+            self._replace({doc.id: doc.to_dict() | {"id": doc.id} for doc in docs})
+
+    def listening(self):
+        return self._watch is not None
+
+    def invalidate(self):
+        # the next read goes to the database, so a write is visible even before the listener reports it
+        with self._lock:
+            self._loaded_at = None
+
+    def age(self):
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def all(self):
+        self._ensure_loaded()
+        return list(self._by_id.values())
+
+    def index(self):
+        self._ensure_loaded()
+        return self._by_id
+
+    def get(self, item_type_id: str):
+        self._ensure_loaded()
+        return self._by_id.get(item_type_id)
+
+    def get_by_name(self, name: str):
+        self._ensure_loaded()
+        return self._by_name.get(name.lower())
+
+    def find(self, filter: str):
+        self._ensure_loaded()
+        needle = filter.strip().lower()
+        if not needle:
+            return list(self._by_id.values())
+        if len(needle) < NGRAM:
+            candidates = self._by_id.values()
+        else:
+            # only the types sharing every piece of the search are checked
+            ids = set.intersection(*(self._ngrams.get(gram, set()) for gram in name_ngrams(needle)))
+            candidates = [self._by_id[i] for i in sorted(ids)]
+        return [t for t in candidates if needle in t.get("name", "").lower()]
+
+    def stats(self):
+        return {
+            "entries": len(self._by_id),
+            "age_seconds": self.age(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "listening": self._watch is not None,
+        }
+
+
+def name_ngrams(name: str):
+    return {name[i:i + NGRAM] for i in range(len(name) - NGRAM + 1)}
+
+
+catalog = ItemTypeCatalog(ITEM_TYPES)
+
+
+class CollectionMirror:
+    # in-memory copy of the fridge or the cart, kept current by a snapshot listener
+    # every change is passed on to the open live pages, and the pages are served from it without reads
+    def __init__(self, collection: str, heap_field: str = None):
+        self.collection = collection
+        self.heap_field = heap_field
+        self.hits = 0
+        self.misses = 0
+        self._docs = {}
+        self._sorted = None
+        # min-heap of (value, id) over heap_field, for the documents with the smallest values first
+        self._heap = []
+        self._ready = False
+        self._watch = None
+        self._subscribers = set()
+        self._lock = threading.RLock()
+
+    def start_listener(self):
+        with self._lock:
+            if self._watch is None:
+                self._watch = db.collection(self.collection).on_snapshot(self._on_snapshot)
+
+    def stop_listener(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+                self._ready = False
+                self._docs = {}
+                self._sorted = None
+                self._heap = []
+
+    def ready(self):
+        return self._ready and self._watch is not None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # called from the listener thread, only the changed documents are applied
+        events = []
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._docs.pop(doc.id, None)
+                    events.append({"op": "remove", "id": doc.id})
+                else:
+                    item = doc.to_dict() | {"id": doc.id}
+                    self._docs[doc.id] = item
+                    self._push(item)
+                    # an added document is appended by the last page only, a modified one replaces a row that is shown
+                    events.append({"op": "add" if change.type.name == "ADDED" else "upsert", "id": doc.id, "item": item})
+            self._sorted = None
+            # the first snapshot only fills the mirror, the open pages already show those rows
+            first = not self._ready
+            self._ready = True
+        bump_version(self.collection)
+        if not first:
+            self._publish(events)
+
+    def apply(self, doc_id: str, data: dict):
+        # a write of this process is visible right away, the listener confirms it later
+        with self._lock:
+            if self._ready:
+                self._docs[doc_id] = self._docs.get(doc_id, {}) | data | {"id": doc_id}
+                self._sorted = None
+                self._push(self._docs[doc_id])
+
+    def _push(self, item: dict):
+        # a changed value is pushed again, the entry with the old value is skipped when it comes up
+        value = item.get(self.heap_field) if self.heap_field else None
+        if value is None:
+            return
+        heapq.heappush(self._heap, (value, item["id"]))
+        if len(self._heap) > 2 * len(self._docs) + 64:
+            self._heap = [(d[self.heap_field], i) for i, d in self._docs.items() if d.get(self.heap_field) is not None]
+            heapq.heapify(self._heap)
+
+    def discard(self, doc_id: str):
+        with self._lock:
+            if self._ready:
+                self._docs.pop(doc_id, None)
+                self._sorted = None
+
+    def get(self, doc_id: str):
+        with self._lock:
+            item = self._docs.get(doc_id)
+        return dict(item) if item is not None else None
+
+    def all(self):
+        with self._lock:
+            self.hits += 1
+            return [dict(item) for item in self._docs.values()]
+
+    def page(self, type_ids: set = None, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+        # the same pages as paginate() over the collection ordered by document id
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._docs)
+            ids, docs = self._sorted, self._docs
+            self.hits += 1
+            if type_ids is not None:
+                ids = [i for i in ids if docs[i].get("type_id") in type_ids]
+            if before:
+                end = bisect.bisect_left(ids, before)
+                start = max(0, end - page_size)
+                rows = [dict(docs[i]) for i in ids[start:end]]
+                return make_page(rows, page_size, "__name__", more=True, has_prev=start > 0)
+            start = bisect.bisect_right(ids, cursor) if cursor else 0
+            rows = [dict(docs[i]) for i in ids[start:start + page_size + 1]]
+        return make_page(rows, page_size, "__name__", more=len(rows) > page_size, has_prev=bool(cursor))
+
+    def upcoming(self, until: any, type_ids: set = None):
+        # the documents whose heap_field is below until, smallest first
+        # the heap is walked from its root without popping, only the entries below the bound are visited
+        found = {}
+        with self._lock:
+            heap, docs = self._heap, self._docs
+            self.hits += 1
+            pending = [(heap[0], 0)] if heap else []
+            while pending:
+                (value, doc_id), i = heapq.heappop(pending)
+                if value >= until:
+                    continue
+                item = docs.get(doc_id)
+                if item is not None and item.get(self.heap_field) == value and doc_id not in found and (type_ids is None or item.get("type_id") in type_ids):
+                    found[doc_id] = dict(item)
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(heap):
+                        heapq.heappush(pending, (heap[child], child))
+        return list(found.values())
+
+    def subscribe(self):
+        # a live page gets its own queue on the running event loop, the listener thread fills it
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(MIRROR_QUEUE_SIZE))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber[1]
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers = {s for s in self._subscribers if s[1] is not queue}
+
+    def _publish(self, events: list):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            for event in events:
+                loop.call_soon_threadsafe(_deliver, queue, event)
+
+    def stats(self):
+        return {
+            "entries": len(self._docs),
+            "hits": self.hits,
+            "misses": self.misses,
+            "listening": self._watch is not None,
+            "subscribers": len(self._subscribers),
+        }
+
+
+def _deliver(queue: asyncio.Queue, event: dict):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # a page that does not keep up is told to reload instead of getting a partial picture
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"op": "reload"})
+
+
+mirrors = {FRIDGE_ITEMS: CollectionMirror(FRIDGE_ITEMS, heap_field="expiry_at"), CART: CollectionMirror(CART)}
+
+def log_range(start: str = None, end: str = None):
+    # set the start and end of the time period, the last 30 days by default
+    # the range is made of whole days, so the daily rollups, the raw scan and the log table cover the same entries,
+    # the end is exclusive, an end date covers that whole day
     now = datetime.now(timezone.utc)
+    start_dt = parse_date(start or rollup_day(now - timedelta(days=30)))
+    end_dt = parse_date(end) + timedelta(days=1) if end else now
+    return start_dt, end_dt
 
-    start_dt = parse_date(start) or (now - timedelta(days=30))
-    end_dt = parse_date(end) or now
+def change_log_query(start: str = None, end: str = None):
+    start_dt, end_dt = log_range(start, end)
+    return change_log_range(start_dt, end_dt)
 
+def change_log_range(start_dt: datetime, end_dt: datetime):
     # Firestore range query
-    logs_ref = (
+    return (
         db.collection(LOG)
         .where("time", ">=", start_dt)
-        .where("time", "<=", end_dt)
+        .where("time", "<", end_dt)
     )
 
-    docs = logs_ref.stream()
+def scan_change_log(filter: str, start: str = None, end: str = None, max_rows: int = PAGE_SIZE):
+    # one pass over the change log fills both the per item statistics and the newest rows of the log table
+    from google.cloud import firestore
+    logs_ref = change_log_query(start, end).order_by("time", direction=firestore.Query.DESCENDING).order_by("__name__", direction=firestore.Query.DESCENDING)
+
+    needle = filter.strip().lower()
 
     # Stats structure
     stats = defaultdict(lambda: {
@@ -34,12 +477,23 @@ def get_item_statistics(filter: str, start: str = None, end: str = None):
         "modify": 0,
         "user_counts": defaultdict(int)
     })
+    rows = []
+    total_rows = 0
 
-    # Process each log entry
-    for doc in docs:
+    # Process each log entry as it arrives, nothing but the kept rows is held in memory
+    for doc in stream_docs(logs_ref):
         data = doc.to_dict()
 
         item = data.get("item")
+        # Apply substring filter
+        if needle and needle not in (item or "").lower():
+            continue
+
+        # only the first max_rows entries are kept for the table, the rest is only counted
+        total_rows += 1
+        if len(rows) < max_rows:
+            rows.append(log_row(data | {"id": doc.id}))
+
         op_type = data.get("op_type")
         user = data.get("user")
 
@@ -53,11 +507,15 @@ def get_item_statistics(filter: str, start: str = None, end: str = None):
         # Track user activity
         stats[item]["user_counts"][user] += 1
 
+    return summarize_statistics(stats), rows, total_rows
+
+def summarize_statistics(stats: dict):
     # Prepare final result
     result = []
     for item, s in stats.items():
         top_user = (
-            max(s["user_counts"].items(), key=lambda x: x[1])[0]
+            # on a tie the first name in alphabetical order, whatever order the entries were read in
+            min(s["user_counts"].items(), key=lambda x: (-x[1], x[0]))[0]
             if s["user_counts"]
             else None
         )
@@ -69,198 +527,965 @@ def get_item_statistics(filter: str, start: str = None, end: str = None):
             "modify_count": s["modify"],
             "top_user": top_user
         })
+    return result
 
-    # Apply substring filter
-    if filter.strip():
-        result = [r for r in result if filter.lower() in r["item"].lower()]
+def get_item_statistics(filter: str, start: str = None, end: str = None):
+    return coalesce(("statistics", filter, start, end), (LOG, ROLLUPS), read_item_statistics, filter, start, end)
+
+def read_item_statistics(filter: str, start: str = None, end: str = None):
+    if rollups_ready():
+        return rollup_statistics(filter, start, end)
+    stats, rows, total = scan_change_log(filter, start, end, max_rows=0)
+    return stats
+
+def get_stats_page(filter: str, start: str = None, end: str = None, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    return coalesce(("stats_page", filter, start, end, page_size, cursor, before), (LOG, ROLLUPS), read_stats_page, filter, start, end, page_size, cursor, before)
+
+def read_stats_page(filter: str, start: str = None, end: str = None, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    # with the daily rollups in place the statistics cost one read per day
+    # and only the rows of the shown page are read from the change log
+    if rollups_ready():
+        stats = rollup_statistics(filter, start, end)
+        # the rollups know every item name logged in the range, also those of deleted types
+        names = [s["item"] for s in stats] if filter.strip() else None
+        page = list_change_log(filter, start, end, page_size, cursor, before, names)
+        total_rows = sum(s["add_count"] + s["delete_count"] + s["modify_count"] for s in stats)
+        return stats, page, total_rows
+    # without them the first page comes out of the same pass that counts the statistics
+    stats, rows, total_rows = scan_change_log(filter, start, end, page_size + 1)
+    if cursor or before:
+        page = list_change_log(filter, start, end, page_size, cursor, before)
+    else:
+        page = make_page(rows, page_size, "time", more=len(rows) > page_size)
+    return stats, page, total_rows
+
+# daily rollups
+# every day has one document in ROLLUPS holding the operation and user counts per item,
+# it is updated together with every change log entry and rebuilt from the log by backfill_rollups
+_rollups_ready = False
+
+def rollup_day(when: datetime):
+    return when.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+def rollup_update(item: str, op_type: str, user: str, when: datetime = None):
+    # the reference and the merge payload are returned so the caller can write them with the log entry
+    from google.cloud import firestore
+    day = rollup_day(when or datetime.now(timezone.utc))
+    doc_ref = db.collection(ROLLUPS).document(day)
+    payload = {
+        "day": parse_date(day),
+        "items": {item: {op_type: firestore.Increment(1), "users": {user: firestore.Increment(1)}}},
+    }
+    return doc_ref, payload
+
+def rollups_ready():
+    # the rollups are only used once the history before them has been backfilled
+    global _rollups_ready
+    if not _rollups_ready:
+        meta = read_doc(db.collection(META).document(ROLLUPS))
+        _rollups_ready = meta.exists and bool(meta.to_dict().get("backfilled_at"))
+    return _rollups_ready
+
+def rollup_range(start_dt: datetime, end_dt: datetime):
+    return (
+        db.collection(ROLLUPS)
+        .where("day", ">=", start_dt)
+        .where("day", "<", end_dt)
+    )
+
+def log_item_names(filter: str, start_dt: datetime, end_dt: datetime):
+    # the item names logged in the range that contain the filter, those of deleted and renamed types included,
+    # taken from the rollups, or from the entries themselves before the rollups are backfilled
+    needle = filter.strip().lower()
+    if rollups_ready():
+        names = set()
+        for doc in stream_docs(rollup_range(start_dt, end_dt)):
+            names.update(doc.to_dict().get("items", {}))
+    else:
+        names = {doc.to_dict().get("item") for doc in stream_docs(change_log_range(start_dt, end_dt))}
+    return sorted(n for n in names if n and needle in n.lower())
+
+def rollup_statistics(filter: str, start: str = None, end: str = None):
+    start_dt, end_dt = log_range(start, end)
+    days = rollup_range(start_dt, end_dt)
+
+    needle = filter.strip().lower()
+    stats = defaultdict(lambda: {
+        "add": 0,
+        "delete": 0,
+        "modify": 0,
+        "user_counts": defaultdict(int)
+    })
+    # merge the buckets of every day in the range
+    for doc in stream_docs(days):
+        for item, counts in doc.to_dict().get("items", {}).items():
+            if needle and needle not in item.lower():
+                continue
+            for op_type in ("add", "delete", "modify"):
+                stats[item][op_type] += counts.get(op_type, 0)
+            for user, n in counts.get("users", {}).items():
+                stats[item]["user_counts"][user] += n
+
+    return summarize_statistics(stats)
+
+def normalize_expiry():
+    # fills in expiry_at for the items written before it existed, from their expiry_date text
+    batch = db.batch()
+    pending = 0
+    scanned = 0
+    updated = 0
+    for doc in stream_docs(db.collection(FRIDGE_ITEMS)):
+        scanned += 1
+        data = doc.to_dict()
+        value = expiry_at(data.get("expiry_date"))
+        if "expiry_at" in data and data["expiry_at"] == value:
+            continue
+        batch.update(doc.reference, {"expiry_at": value})
+        pending += 1
+        updated += 1
+        if pending == 400:
+            commit(batch, FRIDGE_ITEMS)
+            batch = db.batch()
+            pending = 0
+    if pending:
+        commit(batch, FRIDGE_ITEMS)
+    return {"scanned": scanned, "updated": updated}
+
+def rollup_days():
+    return defaultdict(lambda: defaultdict(lambda: {"add": 0, "delete": 0, "modify": 0, "users": defaultdict(int)}))
+
+def count_rollup(days: dict, entry: dict):
+    item, op_type, user, when = entry.get("item"), entry.get("op_type"), entry.get("user"), entry.get("time")
+    if not item or not op_type or not user or not when:
+        return False
+    counts = days[rollup_day(when)][item]
+    if op_type in ("add", "delete", "modify"):
+        counts[op_type] += 1
+    counts["users"][user] += 1
+    return True
+
+def rollup_doc(day: str, items: dict):
+    return {"day": parse_date(day), "items": {item: dict(c, users=dict(c["users"])) for item, c in items.items()}}
+
+def backfill_rollups(start: str = None, end: str = None):
+    # rebuild the daily buckets from the raw change log, the whole history by default
+    from google.cloud import firestore
+    query = db.collection(LOG)
+    if start:
+        query = query.where("time", ">=", parse_date(start))
+    if end:
+        query = query.where("time", "<", parse_date(end) + timedelta(days=1))
+
+    days = rollup_days()
+    entries = 0
+    for doc in stream_docs(query):
+        if count_rollup(days, doc.to_dict()):
+            entries += 1
+
+    # every bucket is overwritten as a whole, in batches below the 500 writes limit
+    batch = db.batch()
+    pending = 0
+    for day, items in days.items():
+        batch.set(db.collection(ROLLUPS).document(day), rollup_doc(day, items))
+        pending += 1
+        if pending == 400:
+            commit(batch, ROLLUPS)
+            batch = db.batch()
+            pending = 0
+    if pending:
+        commit(batch, ROLLUPS)
+
+    write_doc(db.collection(META).document(ROLLUPS), {"backfilled_at": firestore.SERVER_TIMESTAMP}, merge=True)
+    return {"days": len(days), "entries": entries}
+
+# change log archive
+# entries older than the retention window live in one gzip NDJSON file per day, ARCHIVE_DIR/change_log/YYYY/MM/YYYY-MM-DD.ndjson.gz,
+# the meta document records the boundary before which the days are read from the files instead of Firestore
+_archived_before = None
+_archived_checked = None
+# the days before the boundary already compared with the files, each is checked once per process
+_archive_verified = set()
+
+def archived_before():
+    global _archived_before, _archived_checked
+    if _archived_checked is None or time.monotonic() - _archived_checked > ARCHIVE_META_TTL:
+        meta = read_doc(db.collection(META).document(LOG))
+        _archived_before = meta.to_dict().get("archived_before") if meta.exists else None
+        _archived_checked = time.monotonic()
+    return _archived_before
+
+def archive_path(day: str):
+    return os.path.join(ARCHIVE_DIR, LOG, day[:4], day[5:7], f"{day}.ndjson.gz")
 
+def archive_days():
+    # the days with an archive file, oldest first
+    root = os.path.join(ARCHIVE_DIR, LOG)
+    if not os.path.isdir(root):
+        return []
+    days = []
+    for year in os.listdir(root):
+        for month in os.listdir(os.path.join(root, year)):
+            days += [name[:-len(".ndjson.gz")] for name in os.listdir(os.path.join(root, year, month)) if name.endswith(".ndjson.gz")]
+    return sorted(days)
+
+def read_archive_day(day: str):
+    path = archive_path(day)
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    for row in rows:
+        row["time"] = datetime.fromisoformat(row["time"])
+    return rows
+
+def write_archive_day(day: str, rows: list):
+    # written to a temporary file first, so a file is either the old or the new one in full
+    path = archive_path(day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        for row in sorted(rows, key=lambda r: (r["time"], r["id"])):
+            f.write(json.dumps(row | {"time": row["time"].isoformat()}, default=str) + "\n")
+    os.replace(path + ".tmp", path)
+
+def archive_rows(start_dt: datetime, end_dt: datetime, descending: bool = False, names: list = None, position: dict = None):
+    # the archived entries of the timeframe in time order, only one day file is held in memory at a time
+    # position is a decoded cursor, only the rows after it in the given order are returned
+    boundary = archived_before()
+    if boundary is None or start_dt >= boundary:
+        return
+    first, last = rollup_day(start_dt), rollup_day(min(end_dt, boundary))
+    days = [day for day in archive_days() if first <= day <= last]
+    verify_archive(start_dt, min(end_dt, boundary), days)
+    if descending:
+        days.reverse()
+    wanted = set(names) if names is not None else None
+    after = (position["time"], position["__name__"]) if position else None
+    for day in days:
+        rows = [
+            r for r in read_archive_day(day)
+            if start_dt <= r["time"] < end_dt and r["time"] < boundary and (wanted is None or r.get("item") in wanted)
+        ]
+        if after:
+            rows = [r for r in rows if ((r["time"], r["id"]) < after if descending else (r["time"], r["id"]) > after)]
+        rows.sort(key=lambda r: (r["time"], r["id"]), reverse=descending)
+        yield from rows
+
+def verify_archive(start_dt: datetime, end_dt: datetime, present: list):
+    # a day with entries in its rollup has been deleted from Firestore, its file must be there,
+    # a missing one means ARCHIVE_DIR is not the directory the compaction wrote to and the day is left out
+    first = parse_date(rollup_day(start_dt))
+    days = [rollup_day(first + timedelta(days=n)) for n in range((end_dt - first).days + 1)]
+    days = [day for day in days if parse_date(day) < end_dt]
+    if all(day in _archive_verified for day in days):
+        return
+    expected = {doc.id for doc in stream_docs(rollup_range(first, end_dt)) if doc.to_dict().get("items")}
+    for day in sorted(expected - set(present) - _archive_verified):
+        logger.error("The change log of %s was archived, but %s is missing, the day is left out", day, archive_path(day))
+    _archive_verified.update(days)
+
+def compact_change_log(retention_days: int = LOG_RETENTION_DAYS):
+    # moves the entries older than the retention window into the archive, one day at a time:
+    # the day file is written (together with what an earlier run archived of that day), the day's rollup is rebuilt from it,
+    # the boundary moves past the day and only then the entries are deleted, so a run can stop anywhere and be repeated
+    if not rollups_ready():
+        # the statistics of archived days only exist in the rollups
+        backfill_rollups()
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - timedelta(days=retention_days)
+    query = db.collection(LOG).where("time", "<", cutoff).order_by("time").order_by("__name__")
+
+    result = {"days": 0, "entries": 0, "archived_before": None}
+
+    def archive_day(day: str, rows: list):
+        global _archived_before, _archived_checked
+        merged = {r["id"]: r for r in read_archive_day(day)}
+        merged.update({r["id"]: r for r in rows})
+        write_archive_day(day, list(merged.values()))
+        days = rollup_days()
+        for row in merged.values():
+            count_rollup(days, row)
+        write_doc(db.collection(ROLLUPS).document(day), rollup_doc(day, days[day]))
+        boundary = parse_date(day) + timedelta(days=1)
+        current = archived_before()
+        if current is None or boundary > current:
+            write_doc(db.collection(META).document(LOG), {"archived_before": boundary}, merge=True)
+            _archived_before, _archived_checked = boundary, time.monotonic()
+        commit_writes([("delete", db.collection(LOG).document(r["id"]), None) for r in rows], LOG)
+        result["days"] += 1
+        result["entries"] += len(rows)
+
+    day, rows = None, []
+    for doc in stream_docs(query):
+        row = structured_entry(doc.to_dict()) | {"id": doc.id}
+        row_day = rollup_day(row["time"])
+        if row_day != day and rows:
+            archive_day(day, rows)
+            rows = []
+        day = row_day
+        rows.append(row)
+    if rows:
+        archive_day(day, rows)
+    boundary = archived_before()
+    result["archived_before"] = boundary.isoformat() if boundary else None
     return result
 
 def list_item_types(filter: str):
-    # create a generator for documents in ITEM_TYPES collection
-    docs = db.collection(ITEM_TYPES).stream()
-    # turn the documents into dictionaries
-    all_items = [doc.to_dict() | {"id": doc.id} for doc in docs]
-    # apply filter if one is given
-    if filter.strip():
-        filtered = [i for i in all_items if filter.lower() in i.get("name", "").lower()]
+    # item types are served from the in-memory catalog, the filter is applied to the lowercase names
+    return catalog.find(filter)
+
+def item_types_by_id():
+    return catalog.index()
+
+def item_type_name(item_type_id: str):
+    # the name comes from the catalog, a type it does not know yet (or any more) is read on its own
+    # instead of reloading the whole collection
+    item_type = catalog.get(item_type_id)
+    if item_type is None and item_type_id:
+        doc = read_doc(db.collection(ITEM_TYPES).document(item_type_id))
+        item_type = doc.to_dict() if doc.exists else None
+    return item_type.get("name") if item_type else None
+
+def list_fridge_items(filter: str, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    return filter_items(FRIDGE_ITEMS, filter, page_size, cursor, before)
+
+def list_cart_items(filter: str, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    return filter_items(CART, filter, page_size, cursor, before)
+
+def stream_change_log(filter: str, start: str = None, end: str = None):
+    # the entries of the timeframe oldest first, passed on one by one as they are read, for exports
+    start_dt, end_dt = log_range(start, end)
+    names = log_item_names(filter, start_dt, end_dt) if filter.strip() else None
+    for row in change_log_rows(start_dt, end_dt, names):
+        yield log_row(row)
+
+def get_time_series(filter: str, start: str = None, end: str = None, granularity: str = "day"):
+    return coalesce(("time_series", filter, start, end, granularity), (LOG,), read_time_series, filter, start, end, granularity)
+
+def read_time_series(filter: str, start: str = None, end: str = None, granularity: str = "day"):
+    # counts per item, user and period and the quantity changes per item and unit, aggregated with NumPy
+    # imported here so a process that never shows the trends does not load NumPy at startup
+    from backend import timeseries
+    start_dt, end_dt = log_range(start, end)
+    names = log_item_names(filter, start_dt, end_dt) if filter.strip() else None
+    columns = timeseries.Columns()
+    for row in change_log_rows(start_dt, end_dt, names):
+        columns.add(structured_entry(row))
+    return timeseries.aggregate(columns, start_dt, end_dt, granularity)
+
+def change_log_rows(start_dt: datetime, end_dt: datetime, names: list = None):
+    # the archived days come first, then the entries still in Firestore
+    for row in archive_rows(start_dt, end_dt, False, names):
+        yield row
+    query = change_log_range(max(start_dt, archived_before() or start_dt), end_dt)
+    if names is None:
+        queries = [query]
     else:
-        filtered = all_items
-    return filtered
+        queries = [query.where("item", "in", chunk) for chunk in chunks(names, IN_LIMIT)]
+    ordered = [q.order_by("time").order_by("__name__") for q in queries]
+    for doc in merge_streams(ordered, "time", False):
+        yield doc.to_dict() | {"id": doc.id}
 
-def list_fridge_items(filter: str):
-    return filter_items(FRIDGE_ITEMS, filter)
+def list_expiring_items(days: int = EXPIRING_DAYS, filter: str = ""):
+    # the items expiring within the next days, already expired ones included, soonest first
+    mirror = mirrors[FRIDGE_ITEMS]
+    if mirror.ready():
+        return read_expiring_items(days, filter)
+    mirror.misses += 1
+    return coalesce(("expiring", days, filter), (FRIDGE_ITEMS, ITEM_TYPES), read_expiring_items, days, filter)
 
-def list_cart_items(filter: str):
-    return filter_items(CART, filter)
+def read_expiring_items(days: int, filter: str):
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    until = today + timedelta(days=days + 1)
+    type_ids = {t["id"] for t in list_item_types(filter)} if filter.strip() else None
+    mirror = mirrors[FRIDGE_ITEMS]
+    if mirror.ready():
+        items = mirror.upcoming(until, type_ids)
+    else:
+        # a range query on expiry_at, with an "in" on the type for a filter (composite index type_id + expiry_at)
+        query = db.collection(FRIDGE_ITEMS).where("expiry_at", "<", until)
+        if type_ids is None:
+            queries = [query]
+        else:
+            queries = [query.where("type_id", "in", chunk) for chunk in chunks(sorted(type_ids), IN_LIMIT)]
+        ordered = [q.order_by("expiry_at").order_by("__name__") for q in queries]
+        items = [doc.to_dict() | {"id": doc.id} for doc in merge_streams(ordered, "expiry_at", False)]
+    for item in items:
+        item["days_left"] = (item["expiry_at"] - today).days
+    return items
 
-def list_change_log(filter: str, start: str = None, end: str = None):
-    # get the current date and time
-    now = datetime.now(timezone.utc)
+def list_change_log(filter: str, start: str = None, end: str = None, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None, names: list = None):
+    # the newest entries come first
+    # a filter is turned into an "in" query on the item name, the names are those logged in the range
+    start_dt, end_dt = log_range(start, end)
+    if filter.strip() and names is None:
+        names = log_item_names(filter, start_dt, end_dt)
+    # the days before the archive boundary are read from the archive files, after the entries in Firestore
+    boundary = archived_before()
+    archive = None
+    if boundary is not None and start_dt < boundary:
+        start_dt = boundary
+        archive = lambda descending, position: archive_rows(*log_range(start, end), descending, names, position)
+    query = change_log_range(start_dt, end_dt)
+    if not filter.strip():
+        queries = [query]
+    else:
+        queries = [query.where("item", "in", chunk) for chunk in chunks(names, IN_LIMIT)]
+    page = paginate(queries, "time", True, page_size, cursor, before, archive)
+    page["items"] = [log_row(row) for row in page["items"]]
+    return page
 
-    # set the start and end of the time period
-    start_dt = parse_date(start) or (now - timedelta(days=30))
-    end_dt = parse_date(end) or now
 
-    # conditional query to firebase
-    query = (
-        db.collection(LOG)
-        .where("time", ">=", start_dt)
-        .where("time", "<=", end_dt)
-    )
+def filter_items(collection: str, filter: str, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    mirror = mirrors[collection]
+    if mirror.ready():
+        type_ids = {t["id"] for t in list_item_types(filter)} if filter.strip() else None
+        return mirror.page(type_ids, page_size, cursor, before)
+    mirror.misses += 1
+    return coalesce(("items", collection, filter, page_size, cursor, before), (collection, ITEM_TYPES), query_items, collection, filter, page_size, cursor, before)
 
-    # transform the answear to a processable form
-    docs = [doc.to_dict() | {"id": doc.id} for doc in query.stream()]
-    if filter.strip():
-        docs = [d for d in docs if filter.lower() in d.get("item", "").lower()]
+def query_items(collection: str, filter: str, page_size: int = PAGE_SIZE, cursor: str = None, before: str = None):
+    query = db.collection(collection)
+    if not filter.strip():
+        return paginate([query], "__name__", False, page_size, cursor, before)
+    # the filter selects item types in memory, the items are then read by an "in" query on their type
+    type_ids = sorted(t["id"] for t in list_item_types(filter))
+    queries = [query.where("type_id", "in", chunk) for chunk in chunks(type_ids, IN_LIMIT)]
+    return paginate(queries, "__name__", False, page_size, cursor, before)
 
-    return docs
+def chunks(values: list, size: int):
+    return [values[i:i + size] for i in range(0, len(values), size)]
 
+# pagination
+# a page is read with order_by + limit, starting after the cursor of the previous page,
+# a cursor is the document id, preceded by the ordering value when the order is not by id
+def paginate(queries: list, order_field: str, descending: bool, page_size: int, cursor: str = None, before: str = None, archive: any = None):
+    from google.cloud import firestore
+    forward = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+    backward = firestore.Query.ASCENDING if descending else firestore.Query.DESCENDING
+    # a previous page is read in the opposite order, starting before the first row of the current one
+    direction = backward if before else forward
+    position = before or cursor
+    ordered = []
+    for query in queries:
+        query = query.order_by(order_field, direction=direction)
+        if order_field != "__name__":
+            query = query.order_by("__name__", direction=direction)
+        if position:
+            query = query.start_after(decode_cursor(position, order_field))
+        # one row more than the page is read to know whether there is another page
+        ordered.append(query.limit(page_size + 1))
 
-def filter_items(collection: str, filter: str):
-    docs = db.collection(collection).stream()
-    all_items = [doc.to_dict() | {"id": doc.id} for doc in docs]
-    if filter.strip():
-        filtered_types = list_item_types(filter)
-        filtered_types_dict = {item["id"]: item for item in filtered_types}
-        filtered = [i for i in all_items if filtered_types_dict.get(i.get("type_id"))]
+    rows = []
+    stream = (doc.to_dict() | {"id": doc.id} for doc in merge_streams(ordered, order_field, direction == firestore.Query.DESCENDING))
+    if archive is not None:
+        # archived rows are older than every row of the queries, they follow them in descending order
+        older = archive(direction == firestore.Query.DESCENDING, decode_cursor(position, order_field) if position else None)
+        stream = itertools.chain(stream, older) if direction == firestore.Query.DESCENDING else itertools.chain(older, stream)
+    for row in stream:
+        rows.append(row)
+        if len(rows) > page_size:
+            break
+
+    more = len(rows) > page_size
+    if before:
+        rows = rows[:page_size]
+        rows.reverse()
+        return make_page(rows, page_size, order_field, more=True, has_prev=more)
+    return make_page(rows, page_size, order_field, more=more, has_prev=bool(cursor))
+
+def merge_streams(queries: list, order_field: str, descending: bool):
+    # queries split into "in" chunks return sorted streams, they are merged back into one order
+    if len(queries) == 1:
+        return stream_docs(queries[0])
+    if order_field == "__name__":
+        key = lambda doc: doc.id
     else:
-        filtered = all_items
-    return filtered
+        key = lambda doc: (doc.get(order_field), doc.id)
+    return heapq.merge(*(stream_docs(q) for q in queries), key=key, reverse=descending)
+
+def make_page(rows: list, page_size: int, order_field: str, more: bool, has_prev: bool = False):
+    rows = rows[:page_size]
+    return {
+        "items": rows,
+        "next_cursor": encode_cursor(rows[-1], order_field) if more and rows else None,
+        "prev_cursor": encode_cursor(rows[0], order_field) if has_prev and rows else None,
+    }
+
+def encode_cursor(row: dict, order_field: str):
+    if order_field == "__name__":
+        return row["id"]
+    return row[order_field].isoformat() + "|" + row["id"]
+
+class InvalidCursor(ValueError):
+    pass
+
+def decode_cursor(cursor: str, order_field: str):
+    if order_field == "__name__":
+        return {"__name__": cursor}
+    # a cursor comes from the URL, anything not made by encode_cursor is refused
+    try:
+        value, doc_id = cursor.rsplit("|", 1)
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    if not doc_id or when.tzinfo is None:
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    return {order_field: when, "__name__": doc_id}
 
 def add_item_type(name: str, description: str):
     doc_ref = db.collection(ITEM_TYPES).document()
-    doc_ref.set({"name": name, "description": description})
+    write_doc(doc_ref, {"name": name, "description": description})
+    catalog.invalidate()
 
 def add_fridge_item(item_type_id: str, quantity: float, unit: str, user: str, add_photo: UploadFile, expiry: str):
     doc_ref = db.collection(FRIDGE_ITEMS).document()
-    if not add_photo or isinstance(add_photo, str) or add_photo.filename == "":
-        photo_url = None
-        blob_name = None
-    else:
-        photo_url, blob_name = upload_photo(add_photo)
-    doc_ref.set({"type_id": item_type_id, "quantity": quantity, "unit": unit, "photo_url": photo_url, "blob_name": blob_name, "expiry_date": expiry})
+    # a photo is only copied to a temporary file here, it is resized and uploaded in the background
+    staged = None
+    if add_photo and not isinstance(add_photo, str) and add_photo.filename != "":
+        staged = stage_photo(add_photo)
+    # the item and its log entry are committed together
+    batch = db.batch()
+    item = {"type_id": item_type_id, "quantity": quantity, "unit": unit, "photo_url": None, "thumb_url": None, "blob_name": None, "thumb_blob_name": None, "photo_pending": staged is not None, "expiry_date": expiry, "expiry_at": expiry_at(expiry)}
+    batch.set(doc_ref, item)
     #doc_ref.set({"type_id": item_type_id, "quantity": quantity, "unit": unit, "photo_url": photo_url})
-    name_ref = db.collection(ITEM_TYPES).document(item_type_id).get(["name"])
-    name = name_ref.to_dict().get("name")
-    log = db.collection(LOG).document()
-    log.set({"op_type":"add", "new_value": "/"+unit+"/"+str(quantity), "old_value":"","changed_value":"/unit/quantity", "item":name, "time":firestore.SERVER_TIMESTAMP, "user":user})
+    name = item_type_name(item_type_id)
+    add_log(batch, log_entry(LogOp.ADD, name, user, new=item))
+    try:
+        commit(batch, FRIDGE_ITEMS, LOG, ROLLUPS)
+    except BaseException:
+        # the staged photo belongs to no item then
+        if staged:
+            os.remove(staged["path"])
+        raise
+    mirrors[FRIDGE_ITEMS].apply(doc_ref.id, item)
+    if staged:
+        submit_photo(doc_ref, staged)
+
+# bulk changes
+# the writes of many items and their log entries are collected first and committed in as few batches as the limit allows
+def add_fridge_items(items: list, user: str):
+    # items are dicts with type_id, quantity, unit and an optional expiry_date
+    writes = []
+    entries = []
+    added = []
+    for item in items:
+        doc_ref = db.collection(FRIDGE_ITEMS).document()
+        expiry = item.get("expiry_date")
+        data = {"type_id": item["type_id"], "quantity": item["quantity"], "unit": item["unit"], "photo_url": None, "thumb_url": None, "blob_name": None, "thumb_blob_name": None, "photo_pending": False, "expiry_date": expiry, "expiry_at": expiry_at(expiry)}
+        writes.append(("set", doc_ref, data))
+        entries.append(log_entry(LogOp.ADD, item_type_name(item["type_id"]), user, new=data))
+        added.append((doc_ref.id, data))
+    commits = commit_writes(writes + log_writes(entries), FRIDGE_ITEMS, LOG, ROLLUPS)
+    for doc_id, data in added:
+        mirrors[FRIDGE_ITEMS].apply(doc_id, data)
+    return {"added": len(added), "ids": [doc_id for doc_id, _ in added], "commits": commits}
+
+def restock_from_cart(user: str, cart_ids: list = None):
+    # every cart item, or the given ones, becomes a fridge item and leaves the cart
+    from google.api_core.exceptions import NotFound
+    cart = current_docs(CART)
+    if cart_ids is not None:
+        wanted = set(cart_ids)
+        cart = [item for item in cart if item["id"] in wanted]
+    added = []
+    commits = 0
+    # every cart item is deleted on the condition that it still exists, in the batch that creates its fridge item,
+    # so a second restock of the same items fails instead of adding them twice
+    # a group of items with their log entries and the rollup write fits in one batch
+    for group in chunks(cart, (BATCH_LIMIT - 1) // 3):
+        writes = []
+        entries = []
+        moved = []
+        for item in group:
+            doc_ref = db.collection(FRIDGE_ITEMS).document()
+            data = {"type_id": item.get("type_id"), "quantity": item.get("quantity"), "unit": item.get("unit"), "photo_url": None, "thumb_url": None, "blob_name": None, "thumb_blob_name": None, "photo_pending": False, "expiry_date": None, "expiry_at": None}
+            writes.append(("set", doc_ref, data))
+            writes.append(("delete_existing", db.collection(CART).document(item["id"]), None))
+            entries.append(log_entry(LogOp.ADD, item_type_name(item.get("type_id")), user, new=data))
+            moved.append((doc_ref.id, data))
+        try:
+            commits += commit_writes(writes + log_writes(entries), FRIDGE_ITEMS, CART, LOG, ROLLUPS)
+        except NotFound:
+            return {"moved": len(added), "ids": [doc_id for doc_id, _ in added], "commits": commits, "error": "Some cart items were already moved"}
+        for doc_id, data in moved:
+            mirrors[FRIDGE_ITEMS].apply(doc_id, data)
+        for item in group:
+            mirrors[CART].discard(item["id"])
+        added += moved
+    return {"moved": len(added), "ids": [doc_id for doc_id, _ in added], "commits": commits}
+
+def clear_cart():
+    cart = current_docs(CART)
+    commits = commit_writes([("delete", db.collection(CART).document(item["id"]), None) for item in cart], CART)
+    for item in cart:
+        mirrors[CART].discard(item["id"])
+    return {"deleted": len(cart), "commits": commits}
+
+def log_writes(entries: list):
+    # one change log document per entry, and one merge carrying the counts of them all into the rollup of the day
+    from google.cloud import firestore
+    writes = []
+    counts = {}
+    for entry in entries:
+        writes.append(("set", db.collection(LOG).document(), entry | {"time": firestore.SERVER_TIMESTAMP}))
+        if entry.get("item") and entry.get("user"):
+            item = counts.setdefault(entry["item"], {"users": defaultdict(int)})
+            item[entry["op_type"]] = item.get(entry["op_type"], 0) + 1
+            item["users"][entry["user"]] += 1
+    if counts:
+        day = rollup_day(datetime.now(timezone.utc))
+        items = {
+            name: {op: firestore.Increment(n) for op, n in item.items() if op != "users"} | {"users": {u: firestore.Increment(n) for u, n in item["users"].items()}}
+            for name, item in counts.items()
+        }
+        writes.append(("merge", db.collection(ROLLUPS).document(day), {"day": parse_date(day), "items": items}))
+    return writes
+
+def commit_writes(writes: list, *collections: str):
+    # writes are (operation, reference, data) in order, the log entries last so they never describe a change that failed
+    commits = 0
+    for chunk in chunks(writes, BATCH_LIMIT):
+        batch = db.batch()
+        for op, doc_ref, data in chunk:
+            if op == "delete":
+                batch.delete(doc_ref)
+            elif op == "delete_existing":
+                # the whole batch fails with NotFound when the document is already gone
+                batch.delete(doc_ref, option=db.write_option(exists=True))
+            else:
+                batch.set(doc_ref, data, merge=op == "merge")
+        commit(batch, *collections)
+        commits += 1
+    return commits
+
+def current_docs(collection: str):
+    # the whole collection, from the mirror when there is one
+    mirror = mirrors[collection]
+    if mirror.ready():
+        return mirror.all()
+    return [doc.to_dict() | {"id": doc.id} for doc in stream_docs(db.collection(collection))]
 
 def add_cart_item(item_type_id: str, quantity: float, unit: str, user: str):
     doc_ref = db.collection(CART).document()
-    doc_ref.set({"type_id": item_type_id, "quantity": quantity, "unit": unit, "user":user})
+    item = {"type_id": item_type_id, "quantity": quantity, "unit": unit, "user":user}
+    write_doc(doc_ref, item)
+    mirrors[CART].apply(doc_ref.id, item)
 
 # update actions
 def update_item_type(item_type_id: str, name: str, description: str):
     doc_ref = db.collection(ITEM_TYPES).document(item_type_id)
-    doc_ref.set({"name": name, "description": description}, merge=True)
+    write_doc(doc_ref, {"name": name, "description": description}, merge=True)
+    catalog.invalidate()
 
 def update_fridge_item(item_id: str, quantity: float, unit: str, user: str, type_name: str, photo: UploadFile, expiry: str):
     # create a generator for a single document in FRIDGE_ITEMS collection found by its ID
+    from google.api_core.exceptions import NotFound
     doc_ref = db.collection(FRIDGE_ITEMS).document(item_id)
-    # get the unit and quantity before modifications by turning the document into dictionary and extracting the right field, now key
-    old_unit = doc_ref.get().to_dict().get("unit")
-    old_quantity = doc_ref.get().to_dict().get("quantity")
-    # check for whether document has a photo and if yes, get it's name
-    try:
-        old_photo = doc_ref.get().to_dict().get("blob_name")
-    # if there is no photo, set the link to photo to None
-    except Exception:
-        old_photo = None
-
-    # if no new photo is given or an old one does not exist, set photo to none and set the other given variables as given
+    # the values before modifications are taken from the mirror, or from one read of the document
+    old = current_doc(FRIDGE_ITEMS, doc_ref)
+    if old is None:
+        return "Item not found"
+    # if no new photo is given, set the other given variables as given
+    # an update instead of a merge keeps an item deleted in the meantime from coming back
     if not photo or isinstance(photo, str) or photo.filename == "":
-        photo_url = None
-        doc_ref.set({"quantity": quantity, "unit": unit, "expiry_date": expiry}, merge=True)
-        log_change(doc_ref, quantity, unit, user, type_name, old_quantity, old_unit, photo_url)
+        changes = {"quantity": quantity, "unit": unit, "expiry_date": expiry, "expiry_at": expiry_at(expiry)}
+        batch = db.batch()
+        batch.update(doc_ref, changes)
+        add_log(batch, log_entry(LogOp.MODIFY, type_name, user, old=old, new=changes))
+        try:
+            commit(batch, FRIDGE_ITEMS, LOG, ROLLUPS)
+        except NotFound:
+            return "Item not found"
+        mirrors[FRIDGE_ITEMS].apply(item_id, changes)
     else:
-        # if there is a new photo given and an old one exists, delete the old one from the storage and upload a new one
-        if old_photo:
-            deleted = delete_photo(old_photo)
-            if not deleted:
-                return "Failed to delete old photo"
-        photo_url, blob_name = upload_photo(photo)
-        doc_ref.set({"quantity": quantity, "unit": unit, "photo_url": photo_url, "blob_name": blob_name, "expiry_date": expiry}, merge=True)
-        log_change(doc_ref, quantity, unit, user, type_name, old_quantity, old_unit, photo_url)
+        # a new photo is uploaded in the background, the old one is deleted once the new one is in place
+        staged = stage_photo(photo)
+        changes = {"quantity": quantity, "unit": unit, "photo_pending": True, "expiry_date": expiry, "expiry_at": expiry_at(expiry)}
+        batch = db.batch()
+        batch.update(doc_ref, changes)
+        add_log(batch, log_entry(LogOp.MODIFY, type_name, user, old=old, new=changes, photo=True))
+        try:
+            commit(batch, FRIDGE_ITEMS, LOG, ROLLUPS)
+        except NotFound:
+            os.remove(staged["path"])
+            return "Item not found"
+        except BaseException:
+            os.remove(staged["path"])
+            raise
+        mirrors[FRIDGE_ITEMS].apply(item_id, changes)
+        submit_photo(doc_ref, staged, [old.get("blob_name"), old.get("thumb_blob_name")])
 
 def update_cart_item(cart_id: str, quantity: float, unit: str, user: str):
     doc_ref = db.collection(CART).document(cart_id)
+    changes = {"quantity": quantity, "unit": unit, "user" :user}
     try:
-        doc_ref.set({"quantity": quantity, "unit": unit, "user" :user}, merge=True)
+        write_doc(doc_ref, changes, merge=True)
     except:
         return "Failed to update the item"
+    mirrors[CART].apply(cart_id, changes)
 # delete actions
 def delete_item_type(item_type_id: str):
     doc_ref = db.collection(ITEM_TYPES).document(item_type_id)
-    photo_url = doc_ref.get().to_dict().get("photo_url")
-    delete_photo(photo_url)
-    doc_ref.delete()
+    snapshot = read_doc(doc_ref)
+    if not snapshot.exists:
+        return "Item type not found"
+    photo_url = snapshot.to_dict().get("photo_url")
+    if photo_url:
+        delete_photo(photo_url)
+    delete_doc(doc_ref)
+    catalog.invalidate()
 
 def delete_fridge_item(item_id: str, user: str, type_name: str):
     #get values
     doc_ref = db.collection(FRIDGE_ITEMS).document(item_id)
-    old_ref = doc_ref.get()
-    old_unit = old_ref.to_dict().get("unit")
-    old_q = old_ref.to_dict().get("quantity")
-    #set values
-    old_value = "/"+old_unit+"/"+str(old_q)
-    new_value = ""
-    changed_values = "/unit/quantity"
-    try:
-        photo_name = old_ref.to_dict().get("blob_name")
-        delete_photo(photo_name)
-        changed_values+="/photo"
-    except Exception:
-        None
-    doc_ref.delete()
-    #log
-    log = db.collection(LOG).document()
-    log.set({"op_type":"delete","old_value": old_value, "new_value": new_value, "changed_value": changed_values, "item":type_name, "time":firestore.SERVER_TIMESTAMP,"user":user})
+    old = current_doc(FRIDGE_ITEMS, doc_ref)
+    if old is None:
+        return "Item not found"
+    photo_name = old.get("blob_name")
+    photo_deleted = bool(photo_name) and delete_photo(photo_name)
+    if old.get("thumb_blob_name"):
+        delete_photo(old["thumb_blob_name"])
+    #delete and log in one commit
+    batch = db.batch()
+    batch.delete(doc_ref)
+    add_log(batch, log_entry(LogOp.DELETE, type_name, user, old=old, photo=photo_deleted))
+    commit(batch, FRIDGE_ITEMS, LOG, ROLLUPS)
+    mirrors[FRIDGE_ITEMS].discard(item_id)
 
 def delete_cart_item(cart_id: str):
     doc_ref = db.collection(CART).document(cart_id)
-    doc_ref.delete()
-
-def log_change(doc_ref: any, quantity: float, unit: str, user: str, type_name: str, old_quantity: float, old_unit: str, photo_url: str = None):
-    # save old values
-    # initialize old and new fields
-    old_value = ""
-    new_value = ""
-    changed_values = ""
-    # check what"s been changed
-    if unit != old_unit:
-        old_value += "/"+old_unit
-        new_value += "/"+unit
-        changed_values +="/unit"
-    if quantity != old_quantity:
-        old_value += "/"+ str(old_quantity)
-        new_value += "/"+ str(quantity)
-        changed_values +="/quantity"
-    if photo_url:
-        changed_values +="/photo"
-        new_value += "/photo"
-    # save log to db
+    delete_doc(doc_ref)
+    mirrors[CART].discard(cart_id)
+
+def current_doc(collection: str, doc_ref: any):
+    # the mirror already holds the document, otherwise it is read
+    mirror = mirrors[collection]
+    if mirror.ready():
+        return mirror.get(doc_ref.id)
+    snapshot = read_doc(doc_ref)
+    return snapshot.to_dict() if snapshot.exists else None
+
+# change log entries
+# an entry holds the operation, the typed values of the recorded fields before and after, and the names of the changed ones
+# entries written before this schema have the same information as "/"-joined text in old_value, new_value and changed_value
+class LogOp(str, Enum):
+    ADD = "add"
+    MODIFY = "modify"
+    DELETE = "delete"
+
+# the item fields the change log records, in the order the text schema listed them
+LOG_FIELDS = ("unit", "quantity", "expiry_date")
+
+def log_entry(op: LogOp, item: str, user: str, old: dict = None, new: dict = None, photo: bool = False):
+    old = {f: old[f] for f in LOG_FIELDS if old and old.get(f) not in (None, "")}
+    new = {f: new[f] for f in LOG_FIELDS if new and new.get(f) not in (None, "")}
+    if op is LogOp.MODIFY:
+        # only the fields whose value changed are kept, and the unit a changed quantity is in
+        changed = [f for f in LOG_FIELDS if old.get(f) != new.get(f)]
+        kept = changed + ["unit"] if "quantity" in changed else changed
+        old = {f: old[f] for f in kept if f in old}
+        new = {f: new[f] for f in kept if f in new}
+    else:
+        changed = list(new or old)
+    if photo:
+        changed.append("photo")
+    return {"op_type": op.value, "item": item, "user": user, "old": old, "new": new, "changed": changed}
+
+def log_row(entry: dict):
+    # the text fields shown in the log table, derived from the typed ones for the entries of this schema
+    if "changed" not in entry:
+        return entry
+    changed, old, new = entry["changed"], entry.get("old") or {}, entry.get("new") or {}
+    photo = "/photo" if "photo" in changed and entry.get("op_type") == LogOp.MODIFY.value else ""
+    return entry | {
+        "changed_value": "".join("/" + f for f in changed),
+        "old_value": "".join("/" + str(old[f]) for f in changed if f in old),
+        "new_value": "".join("/" + str(new[f]) for f in changed if f in new) + photo,
+    }
+
+def structured_entry(entry: dict):
+    # an entry of the text schema converted to the typed one, the values are split along the changed field names
+    if "changed" in entry:
+        return entry
+    changed = [f for f in (entry.get("changed_value") or "").split("/") if f]
+    fields = [f for f in changed if f != "photo"]
+
+    def values(text: str):
+        parts = [p for p in (text or "").split("/")[1:] if p != "photo"]
+        typed = {}
+        for field, value in zip(fields, parts):
+            if field == "quantity":
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            typed[field] = value
+        return typed
+
+    rest = {k: v for k, v in entry.items() if k not in ("old_value", "new_value", "changed_value")}
+    return rest | {"old": values(entry.get("old_value")), "new": values(entry.get("new_value")), "changed": changed}
+
+def add_log(batch: any, entry: dict):
+    # the change log entry is stored with the server time and counted in its daily rollup,
+    # both are written by the batch that carries the change itself
+    from google.cloud import firestore
     log = db.collection(LOG).document()
-    log.set({"op_type":"modify","old_value": old_value, "new_value": new_value, "changed_value": changed_values, "item":type_name, "time":firestore.SERVER_TIMESTAMP, "user":user})
+    batch.set(log, entry | {"time": firestore.SERVER_TIMESTAMP})
+    if entry.get("item") and entry.get("user"):
+        rollup_ref, rollup = rollup_update(entry["item"], entry["op_type"], entry["user"])
+        batch.set(rollup_ref, rollup, merge=True)
+
+# Firestore access
+# the calls go through these helpers so the reads, writes and commits of a request are counted
+def read_doc(doc_ref: any):
+    count_ops("reads")
+    with timed("firestore"):
+        return doc_ref.get()
+
+def stream_docs(query: any):
+    # the time spent waiting for documents is added up and recorded once the stream ends or is closed
+    elapsed = 0.0
+    documents = iter(query.stream())
+    try:
+        while True:
+            began = time.perf_counter()
+            try:
+                doc = next(documents)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - began
+            count_ops("reads")
+            yield doc
+    finally:
+        record_timing("firestore", elapsed)
+
+def write_doc(doc_ref: any, data: dict, merge: bool = False):
+    count_ops("writes")
+    count_ops("commits")
+    try:
+        with timed("firestore"):
+            return doc_ref.set(data, merge=merge)
+    finally:
+        bump_version(doc_ref.parent.id)
+
+def update_doc(doc_ref: any, data: dict):
+    # unlike write_doc it fails when the document does not exist
+    count_ops("writes")
+    count_ops("commits")
+    try:
+        with timed("firestore"):
+            return doc_ref.update(data)
+    finally:
+        bump_version(doc_ref.parent.id)
+
+def delete_doc(doc_ref: any):
+    count_ops("writes")
+    count_ops("commits")
+    try:
+        with timed("firestore"):
+            return doc_ref.delete()
+    finally:
+        bump_version(doc_ref.parent.id)
+
+def commit(batch: any, *collections: str):
+    # the collections written by the batch get their versions bumped
+    count_ops("writes", len(batch))
+    count_ops("commits")
+    try:
+        with timed("firestore"):
+            return batch.commit()
+    finally:
+        bump_version(*collections)
+
+# photo pipeline
+# the upload is copied to a temporary file in chunks during the request,
+# a worker then resizes it, makes a thumbnail, uploads both and fills in the item's photo fields
+def stage_photo(file: UploadFile):
+    staged = tempfile.NamedTemporaryFile(prefix="photo_", delete=False)
+    with staged:
+        shutil.copyfileobj(file.file, staged, PHOTO_CHUNK)
+    return {"path": staged.name, "filename": file.filename, "content_type": file.content_type}
+
+def submit_photo(doc_ref: any, staged: dict, old_blobs: list = None):
+    _photo_executor.submit(process_photo, doc_ref, staged, old_blobs or [])
+
+def process_photo(doc_ref: any, staged: dict, old_blobs: list):
+    from google.api_core.exceptions import NotFound
+    try:
+        photo_url, blob_name, thumb_url, thumb_blob_name = upload_photo_versions(staged)
+        photo = {"photo_url": photo_url, "blob_name": blob_name, "thumb_url": thumb_url, "thumb_blob_name": thumb_blob_name, "photo_pending": False}
+        try:
+            update_doc(doc_ref, photo)
+            mirrors[FRIDGE_ITEMS].apply(doc_ref.id, photo)
+        except NotFound:
+            # the item was deleted while its photo was processed
+            old_blobs = [blob_name, thumb_blob_name]
+        for old_blob in old_blobs:
+            if old_blob:
+                delete_photo(old_blob)
+    except BaseException:
+        logger.exception("Processing the photo of %s failed", doc_ref.id)
+        # the item keeps its previous photo, or none, instead of showing the photo as pending for ever
+        try:
+            update_doc(doc_ref, {"photo_pending": False})
+            mirrors[FRIDGE_ITEMS].apply(doc_ref.id, {"photo_pending": False})
+        except NotFound:
+            pass
+        except Exception:
+            logger.exception("Clearing the pending photo of %s failed", doc_ref.id)
+    finally:
+        os.remove(staged["path"])
+
+def upload_photo_versions(staged: dict):
+    base_name = f"item_photos/{uuid.uuid4()}_{os.path.splitext(staged['filename'])[0]}"
+    try:
+        image = ImageOps.exif_transpose(Image.open(staged["path"]))
+    except (UnidentifiedImageError, OSError):
+        # not an image Pillow can read, the original is stored and used as its own thumbnail
+        with open(staged["path"], "rb") as f:
+            photo_url, blob_name = upload_photo(f, f"item_photos/{uuid.uuid4()}_{staged['filename']}", staged["content_type"])
+        return photo_url, blob_name, photo_url, blob_name
+    with image:
+        photo_url, blob_name = upload_photo(resized_jpeg(image, PHOTO_MAX_SIZE), base_name + ".jpg", "image/jpeg")
+        thumb_url, thumb_blob_name = upload_photo(resized_jpeg(image, THUMB_SIZE), base_name + "_thumb.jpg", "image/jpeg")
+    return photo_url, blob_name, thumb_url, thumb_blob_name
 
+def resized_jpeg(image: any, size: int):
+    copy = image.convert("RGB")
+    copy.thumbnail((size, size))
+    buffer = io.BytesIO()
+    copy.save(buffer, "JPEG", quality=85, optimize=True)
+    buffer.seek(0)
+    return buffer
 
-def upload_photo(file):
-    bucket = storage.bucket()
-    blob_name = f"item_photos/{uuid.uuid4()}_{file.filename}"
+def upload_photo(file: any, blob_name: str, content_type: str):
+    bucket = get_bucket()
     blob = bucket.blob(blob_name)
-    blob.upload_from_file(file.file, content_type=file.content_type)
-    blob.make_public()
+    # large files are sent as a resumable upload in chunks
+    blob.chunk_size = UPLOAD_CHUNK
+    with timed("photo_upload"):
+        blob.upload_from_file(file, content_type=content_type)
+        blob.make_public()
     return blob.public_url, blob_name
 
 def delete_photo(blob_name):
     try:
-        bucket = storage.bucket()
+        bucket = get_bucket()
         blob = bucket.blob(blob_name)
-        blob.delete()
+        with timed("storage"):
+            blob.delete()
         return True
     except Exception:
         return False
     
+def expiry_at(expiry: str):
+    # the expiry date as a timestamp for range queries, None when it is empty or not a date
+    try:
+        return parse_date(expiry.strip()) if expiry else None
+    except ValueError:
+        return None
+
 def parse_date(date_str: str):
     if not date_str:
         return None
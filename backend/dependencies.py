@@ -1,53 +1,194 @@
 from fastapi import Request, HTTPException, Depends
-import firebase_admin
-from firebase_admin import auth, credentials, firestore
 import os
 import json
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from backend.metrics import count_ops, timed
 
-# firestore init
-if not firebase_admin._apps:
-    if "FIREBASE_CREDENTIALS" in os.environ:
-        cred_dict = json.loads(os.environ["FIREBASE_CREDENTIALS"])
-        cred = credentials.Certificate(cred_dict)
+# data backend
+# "firestore" uses the Firebase project, "local" an in-memory stand-in with photos on the local disk
+DATA_BACKEND = os.environ.get("DATA_BACKEND", "firestore")
+
+# firebase init
+# the Firebase app and its clients are built on first use instead of on import, so a new process starts serving sooner,
+# warm_up() builds them ahead of the first request
+_firebase_lock = threading.Lock()
+
+def firebase_app():
+    import firebase_admin
+    from firebase_admin import credentials
+    with _firebase_lock:
+        if not firebase_admin._apps:
+            if "FIREBASE_CREDENTIALS" in os.environ:
+                cred_dict = json.loads(os.environ["FIREBASE_CREDENTIALS"])
+                cred = credentials.Certificate(cred_dict)
+            else:
+                BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+                cred = credentials.Certificate(os.path.join(BASE_DIR, "app/sec/fridgeapp-5c204-firebase-adminsdk-fbsvc-d1394347c8.json"))
+            firebase_admin.initialize_app(cred, {"storageBucket": "fridgeapp-5c204.firebasestorage.app"})
+        return firebase_admin.get_app()
+
+class LazyClient:
+    # stands in for a client until it is first used, then builds it once and passes every attribute on to it
+    def __init__(self, build):
+        self._build = build
+        self._client = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    with timed("client_init"):
+                        self._client = self._build()
+        return self._client
+
+    def __getattr__(self, name: str):
+        return getattr(self.resolve(), name)
+
+def firestore_client():
+    from firebase_admin import firestore
+    return firestore.client(firebase_app())
+
+def firebase_bucket():
+    from firebase_admin import storage
+    return storage.bucket(app=firebase_app())
+
+def firebase_verify_id_token(token: str):
+    from firebase_admin import auth
+    return auth.verify_id_token(token, app=firebase_app())
+
+if DATA_BACKEND == "local":
+    from backend import local_backend
+    db = local_backend.client()
+    get_bucket = local_backend.bucket
+    verify_id_token = local_backend.verify_id_token
+else:
+    db = LazyClient(firestore_client)
+    get_bucket = firebase_bucket
+    verify_id_token = firebase_verify_id_token
+
+def warm_up():
+    # builds the clients now, so the first request does not pay for it
+    if isinstance(db, LazyClient):
+        db.resolve()
+    get_bucket()
+
+# the Firestore and Storage clients are blocking, their calls run on a bounded pool of threads
+# so a slow query or photo upload does not stall the event loop for the other requests
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # the request's context variables are carried into the worker thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, lambda: ctx.run(func, *args, **kwargs))
+
+# auth caches
+# decoded tokens are kept until their own "exp" so a page load does not re-verify the same token,
+# user profiles are kept for a short time since an admin may change roles in the console
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
+
+_token_cache = OrderedDict()
+_user_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_counts = {"token_hits": 0, "token_misses": 0, "user_hits": 0, "user_misses": 0}
+
+def _cache_get(cache: OrderedDict, key: str, kind: str):
+    now = time.time()
+    with _cache_lock:
+        entry = cache.get(key)
+        if entry is not None and entry[1] > now:
+            # move the entry to the end so the least recently used one is evicted first
+            cache.move_to_end(key)
+            _cache_counts[kind + "_hits"] += 1
+            return entry[0]
+        if entry is not None:
+            del cache[key]
+        _cache_counts[kind + "_misses"] += 1
+        return None
+
+def _cache_put(cache: OrderedDict, key: str, value, expires_at: float, max_size: int):
+    with _cache_lock:
+        cache[key] = (value, expires_at)
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+def _verify_token(token: str):
+    with timed("auth"):
+        decoded = verify_id_token(token)
+    _cache_put(_token_cache, token, decoded, float(decoded.get("exp", 0)), TOKEN_CACHE_SIZE)
+    return decoded
+
+def _load_user_profile(uid: str):
+    # user is located in the users collection 
+    # separate from the uthentication but sharing uids
+    # the information is passed to this backend
+    count_ops("reads")
+    with timed("firestore"):
+        user_doc = db.collection("users").document(uid).get()
+    # the user's data is transformed from a stream to a dictionary
+    if not user_doc.exists:
+        user_data = dict()
     else:
-        BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        cred = credentials.Certificate(os.path.join(BASE_DIR, "app/sec/fridgeapp-5c204-firebase-adminsdk-fbsvc-d1394347c8.json"))
-    firebase_admin.initialize_app(cred, {"storageBucket": "fridgeapp-5c204.firebasestorage.app"})
-db = firestore.client()
+        user_data = user_doc.to_dict()
+    # uid is added to that dictionary
+    user_data["uid"] = uid
+    _cache_put(_user_cache, uid, user_data, time.time() + USER_CACHE_TTL, USER_CACHE_SIZE)
+    return user_data
+
+def auth_cache_stats():
+    with _cache_lock:
+        counts = dict(_cache_counts)
+        counts["token_entries"] = len(_token_cache)
+        counts["user_entries"] = len(_user_cache)
+    for kind in ("token", "user"):
+        total = counts[kind + "_hits"] + counts[kind + "_misses"]
+        counts[kind + "_hit_rate"] = counts[kind + "_hits"] / total if total else 0.0
+    return counts
 
 # users check
 async def get_current_user(request: Request):
+    # the middleware and the route dependencies both ask for the user,
+    # the result of the first call is kept on the request and reused
+    if hasattr(request.state, "auth_result"):
+        result = request.state.auth_result
+    else:
+        result = await _authenticate(request)
+        request.state.auth_result = result
+    if isinstance(result, HTTPException):
+        raise result
+    return result
+
+async def _authenticate(request: Request):
     # take current user's token
     token = request.cookies.get('token') or request.headers.get('Authorization')
     # if there is no token, the user is not signed in and is informed about that
     if not token:
-        raise HTTPException(status_code=401, detail='Not authenticated')
+        return HTTPException(status_code=401, detail='Not authenticated')
     # token: "Bearer: "+ user_info, user info is separated and verified in Firebse
     try:
         if token.startswith('Bearer '):
             token = token.split(' ', 1)[1]
-        decoded = auth.verify_id_token(token)
+        # verify the token in Firebase only if it has not been verified before and has not expired yet,
+        # off the event loop
+        decoded = _cache_get(_token_cache, token, "token") or await run_db(_verify_token, token)
     # if unrecognized by Firebase, the user is informed about that
     except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Unauthorized: {e}")
+        return HTTPException(status_code=401, detail=f"Unauthorized: {e}")
     # user's identification string (uid) is separated from user info
     uid = decoded["uid"]
-    
-    # user is located in the users collection 
-    # separate from the uthentication but sharing uids
-    # the information is passed to this backend
-    user_ref = db.collection("users").document(uid)
-    user_doc = user_ref.get()
-
-    # the user's data is transformed from a stream to a dictionary
-    if not user_doc.exists:
-        user_data = dict()
-    else:
-        user_data = user_doc.to_dict()
-    
-    # uid is added to that dictionary
-    user_data["uid"] = uid
-    return user_data
+    user_data = _cache_get(_user_cache, uid, "user") or await run_db(_load_user_profile, uid)
+    # a copy is returned so the routes can not change the cached profile
+    return dict(user_data)
 
 # admin role check
 # call the function to get current user's data verifying the user in the proccess
@@ -0,0 +1,19 @@
+import os
+
+# production server: gunicorn managing uvicorn workers, run from the project root
+# gunicorn -c backend/gunicorn_conf.py backend.main:app
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# one worker per core by default, every worker has its own caches, mirrors and snapshot listeners
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = os.environ.get("WORKER_CLASS", "uvicorn_worker.UvicornWorker")
+
+# after SIGTERM a worker stops taking connections and gets this many seconds to finish the open requests,
+# keep it below the platform's own stop timeout
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 25))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+
+# the app is imported in every worker after the fork, the gRPC channels of the Firestore client can not be shared
+preload_app = False
+accesslog = os.environ.get("ACCESS_LOG", "-")
@@ -0,0 +1,493 @@
+import os
+import copy
+import uuid
+import time
+import shutil
+import threading
+from datetime import datetime, timezone
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.watch import ChangeType
+
+# local stand-in for Firestore and Cloud Storage, selected with DATA_BACKEND=local
+# it keeps the documents in memory and the photos on the local disk and implements the part of
+# the client API the app uses, so the app can be load-tested and profiled without a Firebase project
+BLOB_DIR = os.environ.get("LOCAL_BLOB_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".local_blobs"))
+BLOB_URL = "/local-blobs"
+# uids that get an admin profile in the users collection
+ADMIN_UIDS = [uid for uid in os.environ.get("LOCAL_ADMIN_UIDS", "admin").split(",") if uid]
+
+_client = None
+_bucket = None
+_init_lock = threading.Lock()
+
+
+def client():
+    # one client per process, shared by every module that imports the backend
+    global _client
+    with _init_lock:
+        if _client is None:
+            _client = LocalClient()
+            _seed_admins(_client)
+        return _client
+
+def _seed_admins(local_client):
+    for uid in ADMIN_UIDS:
+        local_client.collection("users").document(uid).set({"admin": True, "email": f"{uid}@local"})
+
+def bucket():
+    global _bucket
+    with _init_lock:
+        if _bucket is None:
+            _bucket = LocalBucket(BLOB_DIR)
+        return _bucket
+
+def verify_id_token(token: str):
+    # the token is taken as the uid, there is nothing to verify without Firebase
+    if not token:
+        raise ValueError("Empty token")
+    return {"uid": token, "email": f"{token}@local", "exp": time.time() + 3600}
+
+def reset():
+    # drop every document and photo, used between benchmark runs
+    # the client object stays the same since the app modules hold on to it
+    local_client = client()
+    with local_client._lock:
+        local_client._data.clear()
+    _seed_admins(local_client)
+    shutil.rmtree(BLOB_DIR, ignore_errors=True)
+    return local_client
+
+
+# values
+def _now():
+    return datetime.now(timezone.utc)
+
+def _type_rank(value):
+    # Firestore orders values of different types by type first
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    return 5
+
+def _normalize(value):
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, LocalDocumentReference):
+        return value.id
+    return value
+
+def _compare(a, b):
+    a, b = _normalize(a), _normalize(b)
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a == 0 or a == b:
+        return 0
+    return -1 if a < b else 1
+
+def _sort_key(value):
+    value = _normalize(value)
+    rank = _type_rank(value)
+    return (rank, value if rank in (1, 2, 3, 4) else 0)
+
+def _get_field(data: dict, field_path: str):
+    value = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+def _apply(target: dict, data: dict, merge: bool):
+    # writes the values into target, resolving the server timestamp, increment and delete sentinels
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif value is transforms.SERVER_TIMESTAMP:
+            target[key] = _now()
+        elif isinstance(value, transforms.Increment):
+            current = target.get(key)
+            target[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+        elif isinstance(value, dict):
+            nested = target.get(key) if merge and isinstance(target.get(key), dict) else {}
+            _apply(nested, value, merge)
+            target[key] = nested
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+# documents
+class LocalDocumentSnapshot:
+    def __init__(self, reference, data: dict = None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+        self.read_time = _now()
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        return copy.deepcopy(_get_field(self._data or {}, field_path))
+
+
+class LocalDocumentReference:
+    def __init__(self, client, collection: str, doc_id: str):
+        self._client = client
+        self.collection_name = collection
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    @property
+    def parent(self):
+        return LocalCollectionReference(self._client, self.collection_name)
+
+    def get(self, field_paths: list = None):
+        data = self._client._read(self.collection_name, self.id)
+        if data is not None and field_paths:
+            data = {f: _get_field(data, f) for f in field_paths if _has_field(data, f)}
+        return LocalDocumentSnapshot(self, data)
+
+    def set(self, data: dict, merge: bool = False):
+        self._client._commit([("set", self, data, merge)])
+
+    def update(self, data: dict):
+        self._client._commit([("update", self, data, False)])
+
+    def delete(self):
+        self._client._commit([("delete", self, None, False)])
+
+def _has_field(data: dict, field_path: str):
+    try:
+        _get_field(data, field_path)
+        return True
+    except KeyError:
+        return False
+
+
+# queries
+class LocalQuery:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(self, client, collection: str, filters=(), orders=(), limit=None, limit_to_last=False, start_after=None, end_before=None):
+        self._client = client
+        self.collection_name = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._limit_to_last = limit_to_last
+        self._start_after = start_after
+        self._end_before = end_before
+
+    def _copy(self, **changes):
+        args = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "limit_to_last": self._limit_to_last,
+            "start_after": self._start_after,
+            "end_before": self._end_before,
+        }
+        args.update(changes)
+        return LocalQuery(self._client, self.collection_name, **args)
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count, limit_to_last=False)
+
+    def limit_to_last(self, count: int):
+        return self._copy(limit=count, limit_to_last=True)
+
+    def start_after(self, values):
+        return self._copy(start_after=values)
+
+    def end_before(self, values):
+        return self._copy(end_before=values)
+
+    def get(self):
+        return list(self.stream())
+
+    def stream(self):
+        rows = self._client._scan(self.collection_name)
+        rows = [(doc_id, data) for doc_id, data in rows if all(self._matches(doc_id, data, f) for f in self._filters)]
+
+        orders = list(self._orders)
+        # documents are always ordered by id last, in the direction of the last ordering
+        if "__name__" not in [field for field, _ in orders]:
+            orders.append(("__name__", orders[-1][1] if orders else self.ASCENDING))
+        # a document without an ordered field is not part of the result
+        rows = [(doc_id, data) for doc_id, data in rows if all(field == "__name__" or _has_field(data, field) for field, _ in orders)]
+
+        def values(doc_id, data):
+            return [doc_id if field == "__name__" else _get_field(data, field) for field, _ in orders]
+
+        def compare(a, b):
+            for (field, direction), x, y in zip(orders, a, b):
+                result = _compare(x, y)
+                if result:
+                    return -result if direction == self.DESCENDING else result
+            return 0
+
+        # one stable sort per ordered field, the last one first
+        keyed = [(values(doc_id, data), doc_id, data) for doc_id, data in rows]
+        for i in reversed(range(len(orders))):
+            keyed.sort(key=lambda row: _sort_key(row[0][i]), reverse=orders[i][1] == self.DESCENDING)
+        if self._start_after is not None:
+            position = self._cursor_values(self._start_after, orders)
+            keyed = [row for row in keyed if compare(row[0][:len(position)], position) > 0]
+        if self._end_before is not None:
+            position = self._cursor_values(self._end_before, orders)
+            keyed = [row for row in keyed if compare(row[0][:len(position)], position) < 0]
+        if self._limit is not None:
+            keyed = keyed[-self._limit:] if self._limit_to_last else keyed[:self._limit]
+
+        for _, doc_id, data in keyed:
+            yield LocalDocumentSnapshot(LocalDocumentReference(self._client, self.collection_name, doc_id), data)
+
+    def _cursor_values(self, cursor, orders):
+        if isinstance(cursor, LocalDocumentSnapshot):
+            return [cursor.id if field == "__name__" else cursor.get(field) for field, _ in orders]
+        if isinstance(cursor, dict):
+            return [cursor[field] for field, _ in orders if field in cursor]
+        return list(cursor)
+
+    def _matches(self, doc_id: str, data: dict, condition):
+        field, op, expected = condition
+        if field == "__name__":
+            value = doc_id
+        elif _has_field(data, field):
+            value = _get_field(data, field)
+        else:
+            return False
+        if op == "==":
+            return _compare(value, expected) == 0
+        if op == "!=":
+            return _compare(value, expected) != 0
+        if op == "in":
+            if isinstance(value, str):
+                return value in expected
+            return any(_compare(value, e) == 0 for e in expected)
+        if op == "not-in":
+            return all(_compare(value, e) != 0 for e in expected)
+        if op == "array_contains":
+            return isinstance(value, list) and expected in value
+        # range filters only match values of the same type
+        if _type_rank(_normalize(value)) != _type_rank(_normalize(expected)):
+            return False
+        result = _compare(value, expected)
+        return {"<": result < 0, "<=": result <= 0, ">": result > 0, ">=": result >= 0}[op]
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self.collection_name, callback)
+
+
+class LocalCollectionReference(LocalQuery):
+    def __init__(self, client, collection: str):
+        super().__init__(client, collection)
+        self.id = collection
+
+    def document(self, doc_id: str = None):
+        return LocalDocumentReference(self._client, self.collection_name, doc_id or uuid.uuid4().hex[:20])
+
+
+# writes
+class LocalWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self._writes.append(("set", reference, data, merge))
+        return self
+
+    def update(self, reference, data: dict):
+        self._writes.append(("update", reference, data, False))
+        return self
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, option, False))
+        return self
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+
+class LocalWatch:
+    def __init__(self, client, collection: str, callback):
+        self._client = client
+        self.collection = collection
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._client._unlisten(self)
+
+
+class LocalChange:
+    def __init__(self, change_type, document):
+        self.type = change_type
+        self.document = document
+
+
+class LocalSnapshotDocs:
+    # the documents of a snapshot are only built when the listener looks at them,
+    # listeners that just apply the changes do not pay for a copy of the collection
+    def __init__(self, client, collection: str):
+        self._client = client
+        self._collection = collection
+        self._docs = None
+
+    def _load(self):
+        if self._docs is None:
+            self._docs = [LocalDocumentSnapshot(LocalDocumentReference(self._client, self._collection, doc_id), data) for doc_id, data in self._client._scan(self._collection)]
+        return self._docs
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+class LocalWriteOption:
+    # a precondition of a write, only "exists" is supported
+    def __init__(self, exists: bool = None):
+        self.exists = exists
+
+
+class LocalClient:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+        self._watches = []
+
+    def collection(self, name: str):
+        return LocalCollectionReference(self, name)
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+    def write_option(self, exists: bool = None):
+        return LocalWriteOption(exists)
+
+    def _read(self, collection: str, doc_id: str):
+        with self._lock:
+            return self._data.get(collection, {}).get(doc_id)
+
+    def _scan(self, collection: str):
+        # stored documents are never changed in place, a write replaces them,
+        # so the scan can hand out the stored dictionaries and the snapshots copy them on to_dict
+        with self._lock:
+            return list(self._data.get(collection, {}).items())
+
+    def _commit(self, writes: list):
+        changes = []
+        with self._lock:
+            # the writes are checked first so a failing update leaves the batch unapplied, like a commit
+            for op, ref, data, merge in writes:
+                if op == "update" and ref.id not in self._data.get(ref.collection_name, {}):
+                    raise NotFound(f"No document to update: {ref.path}")
+                if op == "delete" and data is not None and data.exists and ref.id not in self._data.get(ref.collection_name, {}):
+                    raise NotFound(f"No document to delete: {ref.path}")
+            for op, ref, data, merge in writes:
+                docs = self._data.setdefault(ref.collection_name, {})
+                existed = ref.id in docs
+                if op == "delete":
+                    if existed:
+                        del docs[ref.id]
+                        changes.append((ref, ChangeType.REMOVED, None))
+                    continue
+                if op == "update":
+                    target = copy.deepcopy(docs[ref.id])
+                    for key, value in data.items():
+                        *parents, last = key.split(".")
+                        node = target
+                        for part in parents:
+                            node = node.setdefault(part, {})
+                        _apply(node, {last: value}, merge=False)
+                else:
+                    target = copy.deepcopy(docs.get(ref.id, {})) if merge else {}
+                    _apply(target, data, merge)
+                docs[ref.id] = target
+                changes.append((ref, ChangeType.MODIFIED if existed else ChangeType.ADDED, target))
+        self._notify(changes)
+        return [_now()] * len(writes)
+
+    def _listen(self, collection: str, callback):
+        watch = LocalWatch(self, collection, callback)
+        with self._lock:
+            self._watches.append(watch)
+            docs = [LocalDocumentSnapshot(LocalDocumentReference(self, collection, doc_id), data) for doc_id, data in self._scan(collection)]
+        # like Firestore the listener gets the current documents first
+        callback(docs, [LocalChange(ChangeType.ADDED, d) for d in docs], _now())
+        return watch
+
+    def _unlisten(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, changes: list):
+        with self._lock:
+            watches = list(self._watches)
+        for watch in watches:
+            relevant = [LocalChange(change_type, LocalDocumentSnapshot(ref, data)) for ref, change_type, data in changes if ref.collection_name == watch.collection]
+            if not relevant:
+                continue
+            watch.callback(LocalSnapshotDocs(self, watch.collection), relevant, _now())
+
+
+# photos
+class LocalBlob:
+    def __init__(self, root: str, name: str):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self.public_url = f"{BLOB_URL}/{name}"
+        self.chunk_size = None
+        self.content_type = None
+
+    def upload_from_file(self, file, content_type: str = None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            shutil.copyfileobj(file, f, self.chunk_size or 1024 * 1024)
+        self.content_type = content_type
+
+    def make_public(self):
+        return None
+
+    def delete(self):
+        if not os.path.exists(self.path):
+            raise NotFound(f"No such object: {self.name}")
+        os.remove(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+class LocalBucket:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name: str):
+        return LocalBlob(self.root, name)
@@ -1,56 +1,176 @@
+import time
+# the startup phases are measured from here, before the heavy imports
+STARTED = time.perf_counter()
 import crud
-from dependencies import get_current_user, require_admin
+from backend.dependencies import get_current_user, require_admin, auth_cache_stats, run_db, warm_up
 from fastapi import File, UploadFile
 from datetime import datetime, timezone, timedelta
+import io
 import os
+import csv
+import json
+import hashlib
+import functools
+import asyncio
+import threading
 from fastapi import FastAPI, Request, Query, Depends, Form, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse
-from urllib.parse import urlencode
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from urllib.parse import urlencode, parse_qs
 from fastapi.responses import FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.exception_handlers import http_exception_handler
 from pathlib import Path
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 import uvicorn
+from backend.metrics import start_op_count, start_request_timings, timed, observe, set_gauge, server_timing, render_prometheus, COUNT_BUCKETS
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 STATIC_DIR = BASE_DIR / "frontend" / "static"
 TEMPLATES_DIR = BASE_DIR / "frontend" / "templates"
 
+# seconds between keep-alive comments on an idle live update stream
+LIVE_PING = float(os.environ.get("LIVE_PING", 15))
+
+# the most items one bulk request may carry
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 500))
+
+# columns of the exports, and the size of the pieces the export streams are sent in
+EXPORT_LOG_FIELDS = ["time", "op_type", "item", "user", "old_value", "new_value", "changed_value", "old", "new", "changed", "id"]
+EXPORT_STATS_FIELDS = ["item", "add_count", "delete_count", "modify_count", "top_user"]
+EXPORT_CHUNK = 64 * 1024
+
+# browser caching of the static files, a fingerprinted URL is kept for a year
+STATIC_MAX_AGE = 365 * 24 * 3600
+FAVICON_MAX_AGE = int(os.environ.get("FAVICON_MAX_AGE", 7 * 24 * 3600))
+
+# "startup" builds the Firebase clients and starts the listeners before the first request is served,
+# "background" serves right away and does it in a thread, the pages read Firestore directly until the listeners are up
+WARM_UP = os.environ.get("WARM_UP", "background")
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     uvicorn.run("backend.main:app", host="0.0.0.0", port=port)
 
-app = FastAPI()
-app.mount('/static', StaticFiles(directory=STATIC_DIR), name='static')
+def start_listeners():
+    warm_up()
+    # keep the item type catalog current from a snapshot listener instead of reloading it
+    if os.environ.get("CATALOG_LISTENER", "1") == "1":
+        crud.catalog.start_listener()
+    # the fridge and the cart are mirrored in memory and pushed to the open pages as they change
+    if os.environ.get("MIRROR_LISTENER", "1") == "1":
+        for mirror in crud.mirrors.values():
+            mirror.start_listener()
+    set_gauge("fridge_startup_seconds", time.perf_counter() - STARTED, phase="warm_up")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    starter = None
+    if WARM_UP == "startup":
+        start_listeners()
+    else:
+        starter = threading.Thread(target=start_listeners, name="warm-up", daemon=True)
+        starter.start()
+    set_gauge("fridge_startup_seconds", time.perf_counter() - STARTED, phase="serving")
+    yield
+    if starter is not None:
+        starter.join()
+    crud.catalog.stop_listener()
+    for mirror in crud.mirrors.values():
+        mirror.stop_listener()
+
+class CachedStaticFiles(StaticFiles):
+    # the content behind a fingerprinted URL never changes, other URLs are revalidated with their ETag
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            # only the URL static_url gives out, with the fingerprint of the current content, is cached for good
+            version = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v", [None])[-1]
+            if version is not None and version == static_digest(path):
+                response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+            else:
+                response.headers["Cache-Control"] = "no-cache"
+        return response
+
+@functools.lru_cache(maxsize=None)
+def static_digest(path: str):
+    # a fingerprint of the content of a static file, read once per process
+    try:
+        return hashlib.sha256((STATIC_DIR / path).read_bytes()).hexdigest()[:12]
+    except OSError:
+        return None
+
+def static_url(path: str):
+    return f"/static/{path}?v={static_digest(path)}"
+
+app = FastAPI(lifespan=lifespan)
+app.mount('/static', CachedStaticFiles(directory=STATIC_DIR), name='static')
+if os.environ.get("DATA_BACKEND") == "local":
+    # photos of the local backend are served from the disk
+    from backend import local_backend
+    app.mount(local_backend.BLOB_URL, StaticFiles(directory=local_backend.BLOB_DIR, check_dir=False), name='local-blobs')
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 templates.env.globals["get_user"] = lambda request: getattr(request.state, "user", None)
+templates.env.globals["static_url"] = static_url
 
 @app.get("/favicon.ico")
 async def favicon():
-    return FileResponse(STATIC_DIR / "favicon.ico")
+    # browsers ask for this URL without a fingerprint, so it is cached for a limited time
+    return FileResponse(STATIC_DIR / "favicon.ico", headers={"Cache-Control": f"public, max-age={FAVICON_MAX_AGE}"})
 
 @app.get('/admin', response_class=HTMLResponse)
 async def admin_page(request: Request, filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg"), user=Depends(require_admin)):
-    types = crud.list_item_types(filter)
-    return templates.TemplateResponse('admin.html', {'request': request, 'types': types, 'filter': filter, 'msg': msg})
+    etag = page_etag(request, crud.ITEM_TYPES)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    types = await run_db(crud.list_item_types, filter)
+    return render(request, 'admin.html', {'request': request, 'types': types, 'filter': filter, 'msg': msg}, etag)
+
+@app.get('/admin/cache-stats')
+async def cache_stats(user=Depends(require_admin)):
+    return JSONResponse({"auth": auth_cache_stats(), "item_types": crud.catalog.stats(), "mirrors": {name: m.stats() for name, m in crud.mirrors.items()}, "coalescing": crud.coalesce_stats()})
 
 @app.get('/fridge', response_class=HTMLResponse)
-async def fridge(request: Request, filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg")):
-    items = crud.list_fridge_items(filter)
-    types = crud.list_item_types("")
-    typesDict = {item["id"]: item for item in types}
-    return templates.TemplateResponse('fridge.html', {'request': request, 'items': items, 'types': types, 'typesDict': typesDict, 'filter': filter, 'msg': msg})
+async def fridge(request: Request, filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg"), page_size: int = Query(crud.PAGE_SIZE, ge=1, le=500), cursor: str = Query(None), before: str = Query(None)):
+    etag = page_etag(request, crud.FRIDGE_ITEMS, crud.ITEM_TYPES)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    # the items and the item types are fetched at the same time
+    page, types, typesDict = await asyncio.gather(run_db(crud.list_fridge_items, filter, page_size, cursor, before), run_db(crud.list_item_types, ""), run_db(crud.item_types_by_id))
+    return render(request, 'fridge.html', {'request': request, 'items': page["items"], 'pager': pageUrls(request, page), 'types': types, 'typesDict': typesDict, 'filter': filter, 'msg': msg}, etag)
 
 @app.get('/cart', response_class=HTMLResponse)
-async def cart(request: Request, filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg")):
-    cart = crud.list_cart_items(filter)
-    types = crud.list_item_types("")
-    typesDict = {item["id"]: item for item in types}
-    return templates.TemplateResponse('cart.html', {'request': request, 'cart': cart, 'types': types, 'typesDict': typesDict, 'filter': filter, 'msg': msg})
+async def cart(request: Request, filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg"), page_size: int = Query(crud.PAGE_SIZE, ge=1, le=500), cursor: str = Query(None), before: str = Query(None)):
+    etag = page_etag(request, crud.CART, crud.ITEM_TYPES)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    page, types, typesDict = await asyncio.gather(run_db(crud.list_cart_items, filter, page_size, cursor, before), run_db(crud.list_item_types, ""), run_db(crud.item_types_by_id))
+    return render(request, 'cart.html', {'request': request, 'cart': page["items"], 'pager': pageUrls(request, page), 'types': types, 'typesDict': typesDict, 'filter': filter, 'msg': msg}, etag)
+
+@app.get('/fridge/expiring', response_class=HTMLResponse)
+async def expiring(request: Request, days: int = Query(crud.EXPIRING_DAYS, ge=0, le=crud.EXPIRING_MAX_DAYS), filter: str = Query("", alias="filter"), msg: str = Query("", alias="msg")):
+    # the days left change with the date even when no item does
+    etag = page_etag(request, crud.FRIDGE_ITEMS, crud.ITEM_TYPES, extra=datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    items, typesDict = await asyncio.gather(run_db(crud.list_expiring_items, days, filter), run_db(crud.item_types_by_id))
+    if wants_json(request):
+        return JSONResponse(jsonable_encoder([item | {"name": typesDict.get(item.get("type_id"), {}).get("name")} for item in items]), headers={"ETag": etag})
+    return render(request, 'expiring.html', {'request': request, 'items': items, 'typesDict': typesDict, 'days': days, 'max_days': crud.EXPIRING_MAX_DAYS, 'filter': filter, 'msg': msg}, etag)
+
+@app.get('/fridge/events')
+async def fridge_events(request: Request, filter: str = Query("", alias="filter")):
+    return await live_events(request, crud.FRIDGE_ITEMS, 'fridge_row.html', 'item', filter)
+
+@app.get('/cart/events')
+async def cart_events(request: Request, filter: str = Query("", alias="filter")):
+    return await live_events(request, crud.CART, 'cart_row.html', 'c', filter)
 
 @app.get('/stats', response_class=HTMLResponse)
-async def stats(request: Request, filter: str = Query("", alias="filter"), start: str = Query(None), end: str = Query(None), msg: str = Query("", alias="msg")):
+async def stats(request: Request, filter: str = Query("", alias="filter"), start: str = Query(None), end: str = Query(None), msg: str = Query("", alias="msg"), page_size: int = Query(crud.PAGE_SIZE, ge=1, le=500), cursor: str = Query(None), before: str = Query(None)):
     if not start:
         default_start = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
     else:
@@ -59,74 +179,131 @@ async def stats(request: Request, filter: str = Query("", alias="filter"), start
         default_end = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     else:
         default_end = end
-    change_log = crud.list_change_log(filter, start, end)
-    stats = crud.get_item_statistics(filter, start, end)
-    return templates.TemplateResponse('stats.html', {'request': request,'stats': stats, 'change_log': change_log, 'filter': filter, 'default_start': default_start, 'default_end': default_end, 'msg': msg})
+    # the default timeframe moves with the date
+    etag = page_etag(request, crud.LOG, crud.ITEM_TYPES, extra=default_end)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    stats, page, change_log_total = await run_db(crud.get_stats_page, filter, start, end, page_size, cursor, before)
+    return render(request, 'stats.html', {'request': request, 'stats': stats, 'change_log': page["items"], 'pager': pageUrls(request, page), 'change_log_total': change_log_total, 'filter': filter, 'default_start': default_start, 'default_end': default_end, 'msg': msg}, etag)
+
+@app.get('/stats/series')
+async def stats_series(request: Request, granularity: str = Query("day", pattern="^(day|week|month)$"), filter: str = Query("", alias="filter"), start: str = Query(None), end: str = Query(None)):
+    # the counts and quantity changes per period as arrays lined up with "periods", ready for a chart
+    etag = page_etag(request, crud.LOG, crud.ITEM_TYPES, extra=datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    series = await run_db(crud.get_time_series, filter, start, end, granularity)
+    return JSONResponse(series, headers={"ETag": etag})
+
+@app.get('/stats/export')
+async def export_change_log(format: str = Query("csv", pattern="^(csv|ndjson)$"), filter: str = Query("", alias="filter"), start: str = Query(None), end: str = Query(None)):
+    # the rows go from the query stream to the response without being collected, whatever the timeframe
+    # the dates are checked before the headers go out, the generator only starts once the response is sent
+    try:
+        crud.log_range(start, end)
+    except ValueError:
+        return JSONResponse({"detail": "Invalid date"}, status_code=status.HTTP_400_BAD_REQUEST)
+    rows = crud.stream_change_log(filter, start, end)
+    return export_response(rows, EXPORT_LOG_FIELDS, format, export_name("change_log", start, end))
+
+@app.get('/stats/export/summary')
+async def export_statistics(format: str = Query("csv", pattern="^(csv|ndjson)$"), filter: str = Query("", alias="filter"), start: str = Query(None), end: str = Query(None)):
+    stats = await run_db(crud.get_item_statistics, filter, start, end)
+    return export_response(iter(stats), EXPORT_STATS_FIELDS, format, export_name("statistics", start, end))
 
 @app.post('/admin/item-type/create')
-async def create_item_type(add_item_name: str = Form(...), add_item_desc: str = Form(...), user=Depends(require_admin)):
-    err = crud.add_item_type(add_item_name, add_item_desc)
-    url = prepareUrl('/admin', err, 'Item type added successfully!')
-    return RedirectResponse(url, status_code=303)
+async def create_item_type(request: Request, add_item_name: str = Form(...), add_item_desc: str = Form(...), user=Depends(require_admin)):
+    err = await run_db(crud.add_item_type, add_item_name, add_item_desc)
+    return respond(request, '/admin', err, 'Item type added successfully!')
 
 @app.post('/fridge/item/create')
-async def add_fridge_item(add_item_item_type_id: str = Form(...), add_item_quantity: float = Form(...), add_item_unit: str = Form(...), add_photo: UploadFile | None = File(None), add_expiry_date:str | None = Form(None), user=Depends(get_current_user)):
-    err = crud.add_fridge_item(add_item_item_type_id, add_item_quantity, add_item_unit, user.get('email'), add_photo, add_expiry_date)
-    url = prepareUrl('/fridge', err, 'Item successfully added to the fridge!')
-    return RedirectResponse(url, status_code=303)
+async def add_fridge_item(request: Request, add_item_item_type_id: str = Form(...), add_item_quantity: float = Form(...), add_item_unit: str = Form(...), add_photo: UploadFile | None = File(None), add_expiry_date:str | None = Form(None), user=Depends(get_current_user)):
+    err = await run_db(crud.add_fridge_item, add_item_item_type_id, add_item_quantity, add_item_unit, user.get('email'), add_photo, add_expiry_date)
+    return respond(request, '/fridge', err, 'Item successfully added to the fridge!')
 
 @app.post('/cart/item/create')
-async def add_cart_item(add_item_item_type_id: str = Form(...), add_item_quantity: float = Form(...), add_item_unit: str = Form(...), user=Depends(get_current_user)):
-    err = crud.add_cart_item(add_item_item_type_id, add_item_quantity, add_item_unit, user.get('email'))
-    url = prepareUrl('/cart', err, 'Item successfully added to the shoping cart!')
-    return RedirectResponse(url, status_code=303)
+async def add_cart_item(request: Request, add_item_item_type_id: str = Form(...), add_item_quantity: float = Form(...), add_item_unit: str = Form(...), user=Depends(get_current_user)):
+    err = await run_db(crud.add_cart_item, add_item_item_type_id, add_item_quantity, add_item_unit, user.get('email'))
+    return respond(request, '/cart', err, 'Item successfully added to the shoping cart!')
 
 @app.post('/fridge/item/addtocart')
-async def add_to_cart(item_type_id: str = Form(...), quantity: float = Form(...), unit: str = Form(...), user=Depends(get_current_user)):
-    err = crud.add_cart_item(item_type_id, quantity, unit, user.get('email'))
-    url = prepareUrl('/fridge', err, 'Item successfully added to the shoping cart!')
-    return RedirectResponse(url, status_code=303)
+async def add_to_cart(request: Request, item_type_id: str = Form(...), quantity: float = Form(...), unit: str = Form(...), user=Depends(get_current_user)):
+    err = await run_db(crud.add_cart_item, item_type_id, quantity, unit, user.get('email'))
+    return respond(request, '/fridge', err, 'Item successfully added to the shoping cart!')
+
+class BulkFridgeItem(BaseModel):
+    type_id: str
+    quantity: float
+    unit: str
+    expiry_date: str | None = None
+
+class BulkFridgeItems(BaseModel):
+    items: list[BulkFridgeItem] = Field(..., min_length=1, max_length=BULK_MAX_ITEMS)
+
+class CartSelection(BaseModel):
+    # no ids means the whole cart
+    ids: list[str] | None = Field(None, max_length=BULK_MAX_ITEMS)
+
+@app.post('/fridge/items/bulk')
+async def add_fridge_items(body: BulkFridgeItems, user=Depends(get_current_user)):
+    types = await run_db(crud.item_types_by_id)
+    unknown = sorted({item.type_id for item in body.items if item.type_id not in types})
+    if unknown:
+        return JSONResponse({"ok": False, "msg": "Unknown item types: " + ", ".join(unknown)}, status_code=400)
+    result = await run_db(crud.add_fridge_items, [item.model_dump() for item in body.items], user.get('email'))
+    return JSONResponse({"ok": True, "msg": f"{result['added']} items added to the fridge!"} | result)
+
+@app.post('/cart/restock')
+async def restock_from_cart(body: CartSelection = CartSelection(), user=Depends(get_current_user)):
+    result = await run_db(crud.restock_from_cart, user.get('email'), body.ids)
+    if result.get("error"):
+        # another restock moved some of the items first, the ones moved here are reported with the error
+        return JSONResponse({"ok": False, "msg": result["error"]} | result, status_code=409)
+    return JSONResponse({"ok": True, "msg": f"{result['moved']} items moved from the cart to the fridge!"} | result)
+
+@app.post('/cart/clear')
+async def clear_cart(user=Depends(get_current_user)):
+    result = await run_db(crud.clear_cart)
+    return JSONResponse({"ok": True, "msg": f"{result['deleted']} items removed from the cart!"} | result)
 
 @app.post('/admin/item-type/update')
-async def update_item_type(item_type_id: str = Form(...), name: str = Form(...), description: str = Form(''), user=Depends(require_admin)):
-    err = crud.update_item_type(item_type_id, name, description)
-    url = prepareUrl('/admin', err, 'Item type modified successfully!')
-    return RedirectResponse(url, status_code=303)
+async def update_item_type(request: Request, item_type_id: str = Form(...), name: str = Form(...), description: str = Form(''), user=Depends(require_admin)):
+    err = await run_db(crud.update_item_type, item_type_id, name, description)
+    return respond(request, '/admin', err, 'Item type modified successfully!')
 
 @app.post('/fridge/item/update')
-async def update_fridge_item(item_id: str = Form(...), type_name: str = Form(...), quantity: float = Form(...), unit: str = Form(...), photo: UploadFile | None = File(None), expiry_date: str | None = Form(None), user=Depends(get_current_user)):
+async def update_fridge_item(request: Request, item_id: str = Form(...), type_name: str = Form(...), quantity: float = Form(...), unit: str = Form(...), photo: UploadFile | None = File(None), expiry_date: str | None = Form(None), user=Depends(get_current_user)):
     
-    err = crud.update_fridge_item(item_id, quantity, unit,user.get('email'), type_name, photo, expiry_date)
-    url = prepareUrl('/fridge', err, 'Item successfully updated in the fridge!')
-    return RedirectResponse(url, status_code=303)
+    err = await run_db(crud.update_fridge_item, item_id, quantity, unit,user.get('email'), type_name, photo, expiry_date)
+    return respond(request, '/fridge', err, 'Item successfully updated in the fridge!')
 
 @app.post('/cart/item/update')
-async def update_cart_item(cart_id: str = Form(...), quantity: float = Form(...), unit: str = Form(...), user=Depends(get_current_user)):
-    err = crud.update_cart_item(cart_id, quantity, unit, user.get('email'))
-    url = prepareUrl('/cart', err, 'Item successfully updated in the shoping cart!')
-    return RedirectResponse(url, status_code=303)
+async def update_cart_item(request: Request, cart_id: str = Form(...), quantity: float = Form(...), unit: str = Form(...), user=Depends(get_current_user)):
+    err = await run_db(crud.update_cart_item, cart_id, quantity, unit, user.get('email'))
+    return respond(request, '/cart', err, 'Item successfully updated in the shoping cart!')
 
 @app.post("/admin/item-type/delete")
-async def delete_item_type(item_type_id: str = Form(...), user=Depends(require_admin)):
-    err = crud.delete_item_type(item_type_id)
-    url = prepareUrl('/admin', err, 'Item type deleted successfully!')
-    return RedirectResponse(url, status_code=303)
+async def delete_item_type(request: Request, item_type_id: str = Form(...), user=Depends(require_admin)):
+    err = await run_db(crud.delete_item_type, item_type_id)
+    return respond(request, '/admin', err, 'Item type deleted successfully!')
 
 @app.post("/fridge/item/delete")
-async def delete_fridge_item(type_name: str = Form(...), item_id: str = Form(...), user=Depends(get_current_user)):
-    err = crud.delete_fridge_item(item_id, user.get('email'), type_name)
-    url = prepareUrl('/fridge', err, 'Item successfully removed from the fridge!')
-    return RedirectResponse(url, status_code=303)
+async def delete_fridge_item(request: Request, type_name: str = Form(...), item_id: str = Form(...), user=Depends(get_current_user)):
+    err = await run_db(crud.delete_fridge_item, item_id, user.get('email'), type_name)
+    return respond(request, '/fridge', err, 'Item successfully removed from the fridge!')
 
 @app.post("/cart/item/delete")
-async def delete_cart_item(cart_id: str = Form(...), user=Depends(get_current_user)):
-    err = crud.delete_cart_item(cart_id)
-    url = prepareUrl('/cart', err, 'Item successfully removed from the cart!')
-    return RedirectResponse(url, status_code=303)
+async def delete_cart_item(request: Request, cart_id: str = Form(...), user=Depends(get_current_user)):
+    err = await run_db(crud.delete_cart_item, cart_id)
+    return respond(request, '/cart', err, 'Item successfully removed from the cart!')
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 @app.get('/login', response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse('login.html', {'request': request})
+    return render(request, 'login.html', {'request': request})
 
 @app.get('/logout')
 async def logout():
@@ -136,7 +313,7 @@ async def logout():
 
 @app.get('/',response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse('login.html', {'request': request})
+    return render(request, 'login.html', {'request': request})
 
 @app.middleware("http")
 async def add_user_to_request(request: Request, call_next):
@@ -150,11 +327,38 @@ async def add_user_to_request(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# added after add_user_to_request so it runs around it and the auth time is part of the request
+# set once the first response of the process has gone out
+first_response = False
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    # the Firestore operations and timings of this request are counted from here on
+    ops = start_op_count()
+    timings = start_request_timings()
+    began = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - began
+
+    # the route template keeps the number of label values small
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    observe("fridge_request_seconds", total, method=request.method, route=path, status=str(response.status_code))
+    observe("fridge_request_document_reads", ops["reads"], COUNT_BUCKETS, route=path)
+    observe("fridge_request_document_writes", ops["writes"], COUNT_BUCKETS, route=path)
+    response.headers["Server-Timing"] = server_timing(timings, total)
+    response.headers["X-Firestore-Ops"] = ";".join(f"{kind}={n}" for kind, n in ops.items())
+    global first_response
+    if not first_response:
+        first_response = True
+        set_gauge("fridge_startup_seconds", time.perf_counter() - STARTED, phase="first_response")
+    return response
+
 @app.exception_handler(HTTPException)
 async def auth_exception_handler(request: Request, exc: HTTPException):
     if exc.status_code == status.HTTP_401_UNAUTHORIZED:
         # Detect if it's an AJAX/fetch call
-        if request.headers.get("x-requested-with") == "XMLHttpRequest" or request.headers.get("accept") == "application/json":
+        if wants_json(request):
             # Return JSON for fetch
             return JSONResponse(
                 {"detail": "Not authenticated"},
@@ -182,7 +386,94 @@ async def auth_exception_handler(request: Request, exc: HTTPException):
             """,
             status_code=403
         )
-    raise exc
+    return await http_exception_handler(request, exc)
+
+@app.exception_handler(crud.InvalidCursor)
+async def invalid_cursor_handler(request: Request, exc: crud.InvalidCursor):
+    return JSONResponse({"detail": str(exc)}, status_code=status.HTTP_400_BAD_REQUEST)
+
+def wants_json(request: Request):
+    # fetch calls of the pages ask for JSON, plain form posts get redirects
+    return request.headers.get("x-requested-with") == "XMLHttpRequest" or "application/json" in request.headers.get("accept", "")
+
+def respond(request: Request, url: str, err: str, message: str):
+    # a fetch caller gets a small acknowledgement, the rows are updated through the live stream
+    if wants_json(request):
+        return JSONResponse({"ok": not err, "msg": err or message}, status_code=400 if err else 200)
+    return RedirectResponse(prepareUrl(url, err, message), status_code=303)
+
+async def live_events(request: Request, collection: str, row_template: str, row_name: str, filter: str):
+    # server-sent events with the rendered row of every changed document
+    mirror = crud.mirrors[collection]
+    if not mirror.ready():
+        # 204 tells the EventSource not to reconnect, the page works with normal posts and reloads then
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    queue = mirror.subscribe()
+    row = templates.get_template(row_template)
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), LIVE_PING)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                if event["op"] in ("add", "upsert"):
+                    item = event["item"]
+                    types, matching = await asyncio.gather(run_db(crud.item_types_by_id), run_db(crud.list_item_types, filter))
+                    if filter.strip() and item.get("type_id") not in {t["id"] for t in matching}:
+                        if event["op"] == "add":
+                            continue
+                        # the row no longer matches the filter of the page
+                        event = {"op": "remove", "id": event["id"]}
+                    else:
+                        event = {"op": event["op"], "id": event["id"], "html": row.render({row_name: item, "typesDict": types})}
+                yield f"event: {event['op']}\ndata: {json.dumps(event)}\n\n"
+                if event["op"] == "reload":
+                    break
+        finally:
+            mirror.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def export_name(kind: str, start: str, end: str):
+    return "_".join([kind, start or "last30days", end or "now"])
+
+def export_response(rows, fields: list, format: str, name: str):
+    # a synchronous generator, Starlette pulls it in a worker thread so the Firestore stream does not block the loop
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{format}"', "X-Accel-Buffering": "no"}
+    return StreamingResponse(export_lines(rows, fields, format), media_type=media_type, headers=headers)
+
+def export_lines(rows, fields: list, format: str):
+    # lines are gathered up to EXPORT_CHUNK, the header goes out at once so the download starts right away
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    if format == "csv":
+        writer.writeheader()
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    for row in rows:
+        values = {k: export_value(row.get(k)) for k in fields}
+        if format == "csv":
+            # the typed values of the structured entries go into one JSON cell each
+            writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in values.items()})
+        else:
+            buffer.write(json.dumps(values, default=str) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
 
 def prepareUrl(url: str, err: str, message: str):
     if not err:
@@ -190,4 +481,48 @@ def prepareUrl(url: str, err: str, message: str):
     else:
         params = urlencode({"msg": err})
     url = f"{url}?{params}"
-    return url
\ No newline at end of file
+    return url
+
+def pageUrls(request: Request, page: dict):
+    # links to the neighbouring pages keep every query parameter except the position and the message
+    params = {k: v for k, v in request.query_params.items() if k not in ("cursor", "before", "msg")}
+    urls = {"next_url": None, "prev_url": None}
+    if page["next_cursor"]:
+        urls["next_url"] = f"{request.url.path}?{urlencode(params | {'cursor': page['next_cursor']})}"
+    if page["prev_cursor"]:
+        urls["prev_url"] = f"{request.url.path}?{urlencode(params | {'before': page['prev_cursor']})}"
+    return urls
+
+def render(request: Request, name: str, context: dict, etag: str = None):
+    # the template is rendered when the response is created, so that is the render time
+    with timed("render"):
+        response = templates.TemplateResponse(request, name, context)
+    if etag:
+        # the browser keeps the page but asks every time whether it is still current
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def page_etag(request: Request, *collections: str, extra: str = ""):
+    # a page is the same as long as its collections, its query (filter, page, message) and its user are
+    user = getattr(request.state, "user", None)
+    key = "|".join([
+        crud.version_tag(*collections),
+        request.url.path,
+        str(sorted(request.query_params.multi_items())),
+        request.headers.get("accept", ""),
+        json.dumps(user, sort_keys=True, default=str),
+        extra,
+    ])
+    return 'W/"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+def not_modified(request: Request, etag: str):
+    match = request.headers.get("if-none-match")
+    if not match:
+        return False
+    return match.strip() == "*" or etag in (tag.strip() for tag in match.split(","))
+
+def not_modified_response(etag: str):
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+set_gauge("fridge_startup_seconds", time.perf_counter() - STARTED, phase="import")
@@ -0,0 +1,42 @@
+import argparse
+import json
+from backend import crud
+
+# maintenance commands, run from the project root:
+# python -m backend.manage backfill-rollups [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+# python -m backend.manage normalize-expiry
+# python -m backend.manage compact-log [--retention-days N]
+
+def backfill_rollups(args):
+    result = crud.backfill_rollups(args.start, args.end)
+    print(json.dumps(result))
+
+def normalize_expiry(args):
+    result = crud.normalize_expiry()
+    print(json.dumps(result))
+
+def compact_log(args):
+    result = crud.compact_change_log(args.retention_days)
+    print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser(prog="backend.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill-rollups", help="rebuild the daily change log rollups")
+    backfill.add_argument("--start", default=None)
+    backfill.add_argument("--end", default=None)
+    backfill.set_defaults(func=backfill_rollups)
+
+    expiry = commands.add_parser("normalize-expiry", help="fill in the expiry_at timestamp of the fridge items from their expiry date")
+    expiry.set_defaults(func=normalize_expiry)
+
+    compact = commands.add_parser("compact-log", help="move the change log entries older than the retention window into the archive files")
+    compact.add_argument("--retention-days", type=int, default=crud.LOG_RETENTION_DAYS)
+    compact.set_defaults(func=compact_log)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
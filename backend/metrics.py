@@ -0,0 +1,162 @@
+import time
+import bisect
+import contextvars
+import threading
+from contextlib import contextmanager
+
+# Firestore operation counters
+# every request gets its own counters through a context variable, the totals cover the whole process
+OPS = ("reads", "writes", "commits")
+
+# upper bounds of the latency histogram buckets in seconds, and of the per request document counts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_request_ops = contextvars.ContextVar("request_ops", default=None)
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+_total_ops = dict.fromkeys(OPS, 0)
+_lock = threading.Lock()
+
+def start_op_count():
+    counts = dict.fromkeys(OPS, 0)
+    _request_ops.set(counts)
+    return counts
+
+def op_counts():
+    # counters of the current request, None outside of a request
+    return _request_ops.get()
+
+def total_op_counts():
+    with _lock:
+        return dict(_total_ops)
+
+def count_ops(kind: str, n: int = 1):
+    counts = _request_ops.get()
+    if counts is not None:
+        counts[kind] += n
+    with _lock:
+        _total_ops[kind] += n
+
+
+# histograms and counters in the Prometheus text format
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_histograms = {}
+_counters = {}
+_gauges = {}
+_help = {}
+
+def describe(name: str, text: str):
+    _help[name] = text
+
+def observe(name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+def inc(name: str, n: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+def set_gauge(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = value
+
+def _labels(labels: tuple, extra: dict = None):
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+        gauge_values = sorted(_gauges.items())
+        total_ops = dict(_total_ops)
+    for kind, n in total_ops.items():
+        counters.append((("fridge_firestore_operations_total", (("kind", kind),)), n))
+
+    described = set()
+    def header(name: str, kind: str):
+        if name not in described:
+            described.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), value in gauge_values:
+        header(name, "gauge")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), histogram in histograms:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(histogram.buckets, histogram.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels(labels, {'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, {'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+# timings
+# a timed block is recorded in its histogram and added to the current request's Server-Timing entry
+def start_request_timings():
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def record_timing(name: str, seconds: float):
+    observe(f"fridge_{name}_seconds", seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+@contextmanager
+def timed(name: str):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - began)
+
+def server_timing(timings: dict, total: float):
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+describe("fridge_request_seconds", "Request latency by route")
+describe("fridge_request_document_reads", "Firestore documents read per request")
+describe("fridge_request_document_writes", "Firestore documents written per request")
+describe("fridge_firestore_seconds", "Time spent in Firestore calls")
+describe("fridge_storage_seconds", "Time spent in Cloud Storage calls")
+describe("fridge_auth_seconds", "Time spent verifying tokens")
+describe("fridge_render_seconds", "Time spent rendering templates")
+describe("fridge_photo_upload_seconds", "Time spent uploading photos")
+describe("fridge_firestore_operations_total", "Firestore operations since the process started")
+describe("fridge_client_init_seconds", "Time spent building the Firebase clients")
+describe("fridge_startup_seconds", "Seconds from the start of the app import to each startup phase")
+describe("fridge_coalesced_reads_total", "Reads answered by an identical read already running or just finished")
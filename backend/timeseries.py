@@ -0,0 +1,138 @@
+import numpy as np
+from datetime import datetime, timezone
+
+# change log time series
+# the entries of a range are loaded into columns, the item and user names as integer codes,
+# every count and quantity change is then one np.bincount over a combined (name, period, operation) code
+GRANULARITIES = ("day", "week", "month")
+OPS = ("add", "delete", "modify")
+DAY = 86400
+
+
+class Columns:
+    def __init__(self):
+        self.items = {}
+        self.users = {}
+        self.units = {}
+        self.time = []
+        self.item = []
+        self.user = []
+        self.op = []
+        # one row per quantity change, a modify that changes the unit has two
+        self.q_time = []
+        self.q_item = []
+        self.q_unit = []
+        self.q_delta = []
+
+    def add(self, entry: dict):
+        op = entry.get("op_type")
+        item, user, when = entry.get("item"), entry.get("user"), entry.get("time")
+        if op not in OPS or not item or not user or not when:
+            return
+        seconds = when.timestamp()
+        item_code = self.items.setdefault(item, len(self.items))
+        self.time.append(seconds)
+        self.item.append(item_code)
+        self.user.append(self.users.setdefault(user, len(self.users)))
+        self.op.append(OPS.index(op))
+
+        old, new = entry.get("old") or {}, entry.get("new") or {}
+        old_q, new_q = quantity(old), quantity(new)
+        old_unit = old.get("unit") or new.get("unit") or ""
+        new_unit = new.get("unit") or old.get("unit") or ""
+        if op == "add":
+            changes = [(new_unit, new_q)]
+        elif op == "delete":
+            changes = [(old_unit, -old_q if old_q is not None else None)]
+        elif "quantity" not in entry.get("changed", ()) and old_unit == new_unit:
+            changes = []
+        elif old_unit == new_unit:
+            changes = [(new_unit, new_q - old_q if new_q is not None and old_q is not None else None)]
+        else:
+            changes = [(old_unit, -old_q if old_q is not None else None), (new_unit, new_q)]
+        for unit, delta in changes:
+            if delta is None:
+                continue
+            self.q_time.append(seconds)
+            self.q_item.append(item_code)
+            self.q_unit.append(self.units.setdefault(unit, len(self.units)))
+            self.q_delta.append(delta)
+
+
+def quantity(values: dict):
+    try:
+        return float(values["quantity"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def period_days(days: np.ndarray, granularity: str):
+    # the first day of the period of every day, as days since the epoch
+    if granularity == "week":
+        # the epoch was a Thursday, weeks start on Monday
+        return days - (days + 3) % 7
+    if granularity == "month":
+        return days.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    return days
+
+
+def periods(start_dt: datetime, end_dt: datetime, granularity: str):
+    # every period of the range, also those without entries, so the series of a chart line up
+    # the end is exclusive
+    first, last = int(start_dt.timestamp() // DAY), int(-(-end_dt.timestamp() // DAY)) - 1
+    return np.unique(period_days(np.arange(first, last + 1, dtype=np.int64), granularity))
+
+
+def aggregate(columns: Columns, start_dt: datetime, end_dt: datetime, granularity: str = "day"):
+    starts = periods(start_dt, end_dt, granularity)
+    n_periods = len(starts)
+
+    def period_index(seconds: list):
+        # the last period starting on or before the day
+        days = np.floor_divide(np.asarray(seconds, dtype=np.float64), DAY).astype(np.int64)
+        return np.clip(np.searchsorted(starts, period_days(days, granularity), side="right") - 1, 0, max(n_periods - 1, 0))
+
+    def counts(codes: list, n: int):
+        # operations per (code, period), one bincount over the combined code
+        combined = (np.asarray(codes, dtype=np.int64) * n_periods + period) * len(OPS) + op
+        return np.bincount(combined, minlength=n * n_periods * len(OPS)).reshape(n, n_periods, len(OPS))
+
+    period = period_index(columns.time)
+    op = np.asarray(columns.op, dtype=np.int64)
+    by_item = counts(columns.item, len(columns.items))
+    by_user = counts(columns.user, len(columns.users))
+
+    q_combined = (np.asarray(columns.q_item, dtype=np.int64) * len(columns.units) + np.asarray(columns.q_unit, dtype=np.int64)) * n_periods + period_index(columns.q_time)
+    n_pairs = len(columns.items) * len(columns.units)
+    quantities = np.bincount(q_combined, weights=np.asarray(columns.q_delta, dtype=np.float64), minlength=n_pairs * n_periods)
+    quantities = quantities.reshape(len(columns.items), len(columns.units), n_periods)
+    has_quantity = np.zeros((len(columns.items), len(columns.units)), dtype=bool)
+    has_quantity.reshape(-1)[np.unique(q_combined // max(n_periods, 1))] = True
+
+    def series(counts: np.ndarray):
+        return {name: counts[:, i].tolist() for i, name in enumerate(OPS)}
+
+    def ranked(names: dict, counts: np.ndarray):
+        # the most active first
+        order = np.argsort(-counts.sum(axis=(1, 2)), kind="stable")
+        by_code = list(names)
+        return [(by_code[code], int(code)) for code in order]
+
+    units = list(columns.units)
+    items = []
+    for name, code in ranked(columns.items, by_item):
+        items.append({"item": name} | series(by_item[code]) | {
+            "quantity": {units[u]: np.round(quantities[code, u], 6).tolist() for u in np.flatnonzero(has_quantity[code])},
+        })
+    users = [{"user": name} | series(by_user[code]) for name, code in ranked(columns.users, by_user)]
+
+    return {
+        "granularity": granularity,
+        "start": start_dt.isoformat(),
+        "end": end_dt.isoformat(),
+        "periods": [datetime.fromtimestamp(int(day) * DAY, timezone.utc).strftime("%Y-%m-%d") for day in starts],
+        "entries": len(columns.time),
+        "totals": series(by_item.sum(axis=0)),
+        "items": items,
+        "users": users,
+    }
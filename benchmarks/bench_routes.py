@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+# the routes are driven in-process against the local data backend, no Firebase project is needed
+# python benchmarks/bench_routes.py                  run and compare with benchmarks/baseline.json
+# python benchmarks/bench_routes.py --save           run and store the results as the new baseline
+os.environ["DATA_BACKEND"] = "local"
+os.environ.setdefault("LOCAL_BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".blobs"))
+os.environ.setdefault("CATALOG_LISTENER", "1")
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "backend")]
+
+import httpx
+import main
+import crud
+from backend import local_backend
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+UNITS = ["Pieces", "Kilograms", "Grams", "Litres", "Mililitres"]
+USERS = [f"user{i}@local" for i in range(6)]
+TOKEN = "admin"
+
+
+def seed(types: int, fridge_items: int, cart_items: int, log_days: int, log_per_day: int, seed_value: int = 1):
+    # the documents are written straight into the local client, it is not part of the measurement
+    rng = random.Random(seed_value)
+    db = local_backend.reset()
+
+    def write_all(collection: str, docs: list):
+        batch = db.batch()
+        for data in docs:
+            batch.set(db.collection(collection).document(), data)
+        batch.commit()
+
+    type_docs = [{"name": f"Item type {i:04d}", "description": f"Description {i}"} for i in range(types)]
+    write_all(crud.ITEM_TYPES, type_docs)
+    crud.catalog.invalidate()
+    type_ids = [t["id"] for t in crud.list_item_types("")]
+    names = [t["name"] for t in type_docs]
+
+    write_all(crud.FRIDGE_ITEMS, [{
+        "type_id": rng.choice(type_ids),
+        "quantity": float(rng.randint(1, 20)),
+        "unit": rng.choice(UNITS),
+        "photo_url": None,
+        "thumb_url": None,
+        "blob_name": None,
+        "thumb_blob_name": None,
+        "photo_pending": False,
+        "expiry_date": expiry,
+        "expiry_at": crud.expiry_at(expiry),
+    } for expiry in ((datetime.now(timezone.utc) + timedelta(days=rng.randint(-5, 60))).strftime("%Y-%m-%d") for _ in range(fridge_items))])
+    write_all(crud.CART, [{
+        "type_id": rng.choice(type_ids),
+        "quantity": float(rng.randint(1, 5)),
+        "unit": rng.choice(UNITS),
+        "user": rng.choice(USERS),
+    } for _ in range(cart_items)])
+
+    # the older half of the log is in the text schema, written before the typed one existed
+    now = datetime.now(timezone.utc)
+    log_docs = []
+    for day in range(log_days):
+        for _ in range(log_per_day):
+            op = rng.choice([crud.LogOp.ADD, crud.LogOp.ADD, crud.LogOp.MODIFY, crud.LogOp.MODIFY, crud.LogOp.DELETE])
+            old = {"unit": rng.choice(UNITS), "quantity": float(rng.randint(1, 20))} if op is not crud.LogOp.ADD else None
+            new = {"unit": rng.choice(UNITS), "quantity": float(rng.randint(1, 20))} if op is not crud.LogOp.DELETE else None
+            entry = crud.log_entry(op, rng.choice(names), rng.choice(USERS), old, new)
+            if day >= log_days // 2:
+                entry = {k: v for k, v in crud.log_row(entry).items() if k not in ("old", "new", "changed")}
+            log_docs.append(entry | {"time": now - timedelta(days=day, seconds=rng.randint(0, 86399))})
+    write_all(crud.LOG, log_docs)
+    crud.backfill_rollups()
+    return {"types": types, "fridge_items": fridge_items, "cart_items": cart_items, "log_entries": len(log_docs)}
+
+
+def scenarios():
+    # every scenario returns the arguments of one request, fresh for every call
+    rng = random.Random(2)
+    type_ids = [t["id"] for t in crud.list_item_types("")]
+    item_ids = [doc.id for doc in local_backend.client().collection(crud.FRIDGE_ITEMS).stream()]
+    rng.shuffle(item_ids)
+    deletable = iter(item_ids[len(item_ids) // 2:])
+    updatable = item_ids[:len(item_ids) // 2]
+    start = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
+    year_ago = (datetime.now(timezone.utc) - timedelta(days=365)).strftime("%Y-%m-%d")
+
+    def create():
+        return ("POST", "/fridge/item/create", {"data": {
+            "add_item_item_type_id": rng.choice(type_ids),
+            "add_item_quantity": str(rng.randint(1, 9)),
+            "add_item_unit": rng.choice(UNITS),
+            "add_expiry_date": "2026-12-01",
+        }})
+
+    def update():
+        return ("POST", "/fridge/item/update", {"data": {
+            "item_id": rng.choice(updatable),
+            "type_name": "Item type 0001",
+            "quantity": str(rng.randint(1, 9)),
+            "unit": rng.choice(UNITS),
+            "expiry_date": "2026-12-02",
+        }})
+
+    def delete():
+        return ("POST", "/fridge/item/delete", {"data": {"item_id": next(deletable), "type_name": "Item type 0002"}})
+
+    return {
+        "GET /fridge": lambda: ("GET", "/fridge", {}),
+        "GET /fridge?filter": lambda: ("GET", "/fridge?filter=type 01", {}),
+        "GET /cart": lambda: ("GET", "/cart", {}),
+        "GET /stats": lambda: ("GET", f"/stats?start={start}", {}),
+        "GET /stats (1 year)": lambda: ("GET", f"/stats?start={year_ago}", {}),
+        "POST /fridge/item/create": create,
+        "POST /fridge/item/update": update,
+        "POST /fridge/item/delete": delete,
+    }
+
+
+def parse_ops(header: str):
+    return {kind: int(n) for kind, n in (part.split("=") for part in header.split(";") if part)} if header else {}
+
+
+async def run_scenario(client: httpx.AsyncClient, make_request, requests: int, concurrency: int):
+    latencies = []
+    ops = []
+    pending = iter(range(requests))
+
+    async def worker():
+        for _ in pending:
+            method, url, kwargs = make_request()
+            began = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - began)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method} {url} returned {response.status_code}")
+            ops.append(parse_ops(response.headers.get("x-firestore-ops")))
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - began
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "p50_ms": round(percentile(50), 2),
+        "p95_ms": round(percentile(95), 2),
+        "p99_ms": round(percentile(99), 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "rps": round(requests / elapsed, 1),
+        "ops_per_request": {kind: round(statistics.fmean(o.get(kind, 0) for o in ops), 2) for kind in ("reads", "writes", "commits")},
+    }
+
+
+async def run(args):
+    seeded = seed(args.types, args.fridge_items, args.cart_items, args.log_days, args.log_per_day)
+    results = {"seed": seeded, "config": config(args), "scenarios": {}}
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies={"token": TOKEN}) as client:
+            makers = scenarios()
+            for name, make_request in makers.items():
+                if args.only and args.only not in name:
+                    continue
+                # one warm-up request fills the caches the way a running server has them
+                method, url, kwargs = make_request()
+                await client.request(method, url, **kwargs)
+                for concurrency in args.concurrency:
+                    result = await run_scenario(client, make_request, args.requests, concurrency)
+                    results["scenarios"].setdefault(name, {})[str(concurrency)] = result
+                    print(f"{name:28} c={concurrency:<3} p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms "
+                          f"p99={result['p99_ms']:8.2f}ms {result['rps']:8.1f} req/s ops={result['ops_per_request']}")
+    return results
+
+
+def config(args):
+    # the settings a result depends on, only results of the same settings are compared
+    return {"requests": args.requests, "concurrency": args.concurrency, "only": args.only}
+
+
+def compare(results: dict, baseline: dict):
+    # latency and op count changes against the stored baseline, positive is slower or more reads
+    for key in ("seed", "config"):
+        if results[key] != baseline.get(key):
+            print(f"\nNot compared with the baseline, the {key} differs: {results[key]} against {baseline.get(key)}")
+            return
+    print("\nChange against baseline:")
+    for name, levels in results["scenarios"].items():
+        for concurrency, result in levels.items():
+            base = baseline.get("scenarios", {}).get(name, {}).get(concurrency)
+            if not base:
+                continue
+            p95 = (result["p95_ms"] - base["p95_ms"]) / base["p95_ms"] * 100 if base["p95_ms"] else 0.0
+            rps = (result["rps"] - base["rps"]) / base["rps"] * 100 if base["rps"] else 0.0
+            ops = {kind: round(result["ops_per_request"][kind] - base["ops_per_request"].get(kind, 0), 2) for kind in result["ops_per_request"]}
+            print(f"{name:28} c={concurrency:<3} p95 {p95:+7.1f}%  req/s {rps:+7.1f}%  ops {ops}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the FastAPI routes against the local data backend")
+    parser.add_argument("--types", type=int, default=300)
+    parser.add_argument("--fridge-items", type=int, default=3000)
+    parser.add_argument("--cart-items", type=int, default=300)
+    parser.add_argument("--log-days", type=int, default=365)
+    parser.add_argument("--log-per-day", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario and concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--only", default=None, help="run only the scenarios whose name contains this text")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--output", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.save:
+        BASELINE.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"\nBaseline written to {BASELINE}")
+    elif BASELINE.exists():
+        compare(results, json.loads(BASELINE.read_text()))
+
+
+if __name__ == "__main__":
+    main_cli()
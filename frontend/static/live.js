@@ -0,0 +1,72 @@
+// live tables
+// the rows of the table are patched from server-sent events, so an edit does not reload the page,
+// while the stream is open the forms are sent with fetch and answered with a small JSON acknowledgement
+let liveSource = null;
+
+function liveTable(tableId, eventsUrl) {
+    const tbody = document.getElementById(tableId).tBodies[0];
+    // new rows belong on this page only when it is the last one
+    const lastPage = !document.querySelector(".pager a[href*='cursor=']");
+
+    liveSource = new EventSource(eventsUrl);
+    function parseRow(html) {
+        const template = document.createElement("template");
+        template.innerHTML = html.trim();
+        return template.content.firstElementChild;
+    }
+    // a changed document replaces its row when this page shows it
+    liveSource.addEventListener("upsert", function (event) {
+        const data = JSON.parse(event.data);
+        const current = document.getElementById("row-" + data.id);
+        if (current) current.replaceWith(parseRow(data.html));
+    });
+    // a new document is appended on the last page
+    liveSource.addEventListener("add", function (event) {
+        const data = JSON.parse(event.data);
+        if (lastPage && !document.getElementById("row-" + data.id)) tbody.appendChild(parseRow(data.html));
+    });
+    liveSource.addEventListener("remove", function (event) {
+        const current = document.getElementById("row-" + JSON.parse(event.data).id);
+        if (current) current.remove();
+    });
+    liveSource.addEventListener("reload", function () {
+        liveSource.close();
+        window.location.reload();
+    });
+    liveSource.onerror = function () {
+        // without the stream the forms fall back to normal posts and redirects
+        if (liveSource.readyState === EventSource.CLOSED) liveSource = null;
+    };
+
+    document.addEventListener("submit", function (event) {
+        const form = event.target;
+        // the search form is a get and stays a normal navigation
+        if (form.method.toLowerCase() !== "post") return;
+        if (form.classList.contains("delete-form")) return;
+        if (!liveSource || liveSource.readyState !== EventSource.OPEN) return;
+        event.preventDefault();
+        sendForm(form);
+    });
+}
+
+function sendForm(form) {
+    if (!liveSource || liveSource.readyState !== EventSource.OPEN) {
+        form.submit();
+        return;
+    }
+    fetch(form.action, {
+        method: "POST",
+        headers: { "X-Requested-With": "XMLHttpRequest" },
+        body: new FormData(form)
+    })
+    .then(async response => {
+        if (response.status === 401) {
+            window.location.href = "/login";
+            return;
+        }
+        const ack = await response.json();
+        if (ack.ok && form.id === "addItemForm") form.reset();
+        Swal.fire({ toast: true, position: "top-end", timer: 2500, showConfirmButton: false, icon: ack.ok ? "success" : "error", title: ack.msg });
+    })
+    .catch(error => Swal.fire("Error", "Request failed: " + error, "error"));
+}
@@ -0,0 +1,42 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# the tests run against the local data backend, the mirrors are off so every read goes to the client and is counted
+os.environ["DATA_BACKEND"] = "local"
+os.environ["MIRROR_LISTENER"] = "0"
+os.environ["WARM_UP"] = "startup"
+os.environ.setdefault("LOCAL_BLOB_DIR", str(Path(__file__).resolve().parent / ".blobs"))
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "backend")]
+
+from fastapi.testclient import TestClient
+import main
+import crud
+from backend import local_backend
+
+TOKEN = "admin"
+
+
+@pytest.fixture
+def client():
+    local_backend.reset()
+    crud.catalog.invalidate()
+    # the module state read from the database of an earlier test
+    crud._rollups_ready = False
+    crud._archived_before = crud._archived_checked = None
+    crud._archive_verified.clear()
+    crud.bump_version(crud.LOG, crud.ROLLUPS, crud.ITEM_TYPES, crud.FRIDGE_ITEMS, crud.CART)
+    with TestClient(main.app, cookies={"token": TOKEN}) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def fridge_item(client):
+    crud.add_item_type("Milk", "")
+    type_id = crud.list_item_types("Milk")[0]["id"]
+    crud.add_fridge_item(type_id, 1.0, "Litres", "test@local", None, "2030-01-01")
+    return next(iter(local_backend.client().collection(crud.FRIDGE_ITEMS).stream())).id
@@ -0,0 +1,87 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import crud
+from backend import local_backend
+
+DAYS = 10
+PER_DAY = 3
+RETENTION = 5
+
+
+@pytest.fixture
+def change_log(client, tmp_path, monkeypatch):
+    # three entries a day for the last ten days, the rollups backfilled as on a running server
+    monkeypatch.setattr(crud, "ARCHIVE_DIR", str(tmp_path))
+    db = local_backend.client()
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    batch = db.batch()
+    for day in range(1, DAYS + 1):
+        for n in range(PER_DAY):
+            op = (crud.LogOp.ADD, crud.LogOp.MODIFY, crud.LogOp.DELETE)[n]
+            old = {"unit": "Pieces", "quantity": float(day)} if op is not crud.LogOp.ADD else None
+            new = {"unit": "Pieces", "quantity": float(day + n)} if op is not crud.LogOp.DELETE else None
+            entry = crud.log_entry(op, f"Item {day % 4}", f"user{n}@local", old, new)
+            batch.set(db.collection(crud.LOG).document(), entry | {"time": today - timedelta(days=day) + timedelta(hours=6 * n + 1)})
+    batch.commit()
+    crud.backfill_rollups()
+    return (today - timedelta(days=DAYS + 1)).strftime("%Y-%m-%d")
+
+
+def all_pages(start: str, page_size: int):
+    pages = [crud.list_change_log("", start, page_size=page_size)]
+    while pages[-1]["next_cursor"]:
+        pages.append(crud.list_change_log("", start, page_size=page_size, cursor=pages[-1]["next_cursor"]))
+    return pages
+
+
+def ids(page: dict):
+    return [row["id"] for row in page["items"]]
+
+
+def export(client, start: str):
+    response = client.get(f"/stats/export?format=ndjson&start={start}")
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def statistics(start: str):
+    return sorted(crud.get_item_statistics("", start), key=lambda s: s["item"])
+
+
+def test_compaction_moves_the_old_days_into_the_archive(change_log):
+    result = crud.compact_change_log(RETENTION)
+    # the days before today minus the retention are archived
+    assert result["days"] == DAYS - RETENTION
+    assert result["entries"] == (DAYS - RETENTION) * PER_DAY
+    assert len(crud.archive_days()) == result["days"]
+    remaining = list(local_backend.client().collection(crud.LOG).stream())
+    assert len(remaining) == RETENTION * PER_DAY
+    # a second run finds nothing left to move
+    assert crud.compact_change_log(RETENTION)["entries"] == 0
+
+
+def test_pages_cross_the_archive_boundary_in_both_directions(change_log):
+    before = all_pages(change_log, 4)
+    crud.compact_change_log(RETENTION)
+    after = all_pages(change_log, 4)
+    assert [ids(p) for p in after] == [ids(p) for p in before]
+    assert sum(len(p["items"]) for p in after) == DAYS * PER_DAY
+
+    # back from the last page to the first one
+    page = after[-1]
+    for expected in reversed(after[:-1]):
+        page = crud.list_change_log("", change_log, page_size=4, before=page["prev_cursor"])
+        assert ids(page) == ids(expected)
+    assert page["prev_cursor"] is None
+
+
+def test_export_and_statistics_are_unchanged_by_compaction(client, change_log):
+    exported, stats = export(client, change_log), statistics(change_log)
+    crud.compact_change_log(RETENTION)
+    assert export(client, change_log) == exported
+    assert len(exported) == DAYS * PER_DAY
+    assert statistics(change_log) == stats
+    assert sum(s["add_count"] + s["modify_count"] + s["delete_count"] for s in stats) == DAYS * PER_DAY
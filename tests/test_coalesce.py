@@ -0,0 +1,64 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import crud
+from backend.metrics import total_op_counts
+
+CALLERS = 8
+
+
+def joined_by_all(before: dict):
+    # the leader's read only goes on once every other caller waits for it
+    deadline = time.monotonic() + 5
+    while crud.coalesce_stats()["joined"] - before["joined"] < CALLERS - 1:
+        assert time.monotonic() < deadline, "the callers did not join the running read"
+        time.sleep(0.001)
+
+
+def concurrent_reads():
+    with ThreadPoolExecutor(CALLERS) as pool:
+        futures = [pool.submit(crud.list_fridge_items, "") for _ in range(CALLERS)]
+    return futures
+
+
+def test_identical_reads_run_once(client, fridge_item, monkeypatch):
+    crud.query_items(crud.FRIDGE_ITEMS, "")
+    before_reads = total_op_counts()["reads"]
+    crud.query_items(crud.FRIDGE_ITEMS, "")
+    one_query = total_op_counts()["reads"] - before_reads
+    assert one_query > 0
+
+    query_items = crud.query_items
+    before = crud.coalesce_stats()
+
+    def slow_query_items(*args):
+        joined_by_all(before)
+        return query_items(*args)
+
+    monkeypatch.setattr(crud, "query_items", slow_query_items)
+    before_reads = total_op_counts()["reads"]
+    results = [future.result() for future in concurrent_reads()]
+    after = crud.coalesce_stats()
+    assert after["leaders"] - before["leaders"] == 1
+    assert after["joined"] - before["joined"] == CALLERS - 1
+    assert total_op_counts()["reads"] - before_reads == one_query
+    assert all(result is results[0] for result in results)
+    assert [item["id"] for item in results[0]["items"]] == [fridge_item]
+
+
+def test_an_error_of_the_read_reaches_every_caller(client, monkeypatch):
+    before = crud.coalesce_stats()
+
+    def failing_query_items(*args):
+        joined_by_all(before)
+        raise RuntimeError("read failed")
+
+    monkeypatch.setattr(crud, "query_items", failing_query_items)
+    for future in concurrent_reads():
+        with pytest.raises(RuntimeError, match="read failed"):
+            future.result()
+    # a failed read is not kept, the next call runs it again
+    monkeypatch.undo()
+    assert crud.list_fridge_items("")["items"] == []
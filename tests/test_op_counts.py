@@ -0,0 +1,35 @@
+import crud
+from backend.metrics import start_op_count, op_counts, total_op_counts
+
+
+def parse_ops(header: str):
+    return {kind: int(n) for kind, n in (part.split("=") for part in header.split(";"))}
+
+
+def test_update_costs_one_read_and_one_commit(client, fridge_item):
+    # the first request loads the user profile, the second one only pays for the update
+    client.get("/fridge")
+    response = client.post("/fridge/item/update", data={
+        "item_id": fridge_item,
+        "type_name": "Milk",
+        "quantity": "2",
+        "unit": "Litres",
+        "expiry_date": "2030-01-02",
+    }, follow_redirects=False)
+    assert response.status_code == 303
+    assert parse_ops(response.headers["x-firestore-ops"]) == {"reads": 1, "writes": 3, "commits": 1}
+
+
+def test_update_counts_in_the_current_context_and_the_totals(client, fridge_item):
+    before = total_op_counts()
+    start_op_count()
+    assert crud.update_fridge_item(fridge_item, 3.0, "Litres", "test@local", "Milk", None, "2030-01-03") is None
+    assert op_counts() == {"reads": 1, "writes": 3, "commits": 1}
+    after = total_op_counts()
+    assert {kind: after[kind] - before[kind] for kind in after} == op_counts()
+
+
+def test_update_of_a_missing_item_commits_nothing(client):
+    start_op_count()
+    assert crud.update_fridge_item("missing", 3.0, "Litres", "test@local", "Milk", None, None) == "Item not found"
+    assert op_counts()["commits"] == 0
@@ -0,0 +1,40 @@
+import crud
+from backend import local_backend
+
+
+def cart_with(count: int):
+    crud.add_item_type("Milk", "")
+    type_id = crud.list_item_types("Milk")[0]["id"]
+    for n in range(count):
+        crud.add_cart_item(type_id, float(n + 1), "Litres", "test@local")
+    return crud.current_docs(crud.CART)
+
+
+def fridge_items():
+    return [doc.to_dict() for doc in local_backend.client().collection(crud.FRIDGE_ITEMS).stream()]
+
+
+def test_a_second_restock_moves_nothing(client):
+    cart_with(3)
+    first = client.post("/cart/restock", json={})
+    assert first.status_code == 200
+    assert first.json()["moved"] == 3
+    second = client.post("/cart/restock", json={})
+    assert second.status_code == 200
+    assert second.json()["moved"] == 0
+    assert sorted(item["quantity"] for item in fridge_items()) == [1.0, 2.0, 3.0]
+    assert crud.current_docs(crud.CART) == []
+
+
+def test_a_restock_of_stale_items_is_refused(client, monkeypatch):
+    # groups of two items, the second request read the cart before the first one moved its last two items
+    monkeypatch.setattr(crud, "BATCH_LIMIT", 7)
+    stale = cart_with(4)
+    ids = [item["id"] for item in stale]
+    assert client.post("/cart/restock", json={"ids": ids[2:]}).json()["moved"] == 2
+    monkeypatch.setattr(crud, "current_docs", lambda collection: stale)
+    response = client.post("/cart/restock", json={"ids": ids})
+    assert response.status_code == 409
+    assert response.json()["moved"] == 2
+    # the group holding the moved items was not committed, no item is in the fridge twice
+    assert sorted(item["quantity"] for item in fridge_items()) == [1.0, 2.0, 3.0, 4.0]